@@ -0,0 +1,318 @@
+"""
+Scaling benchmark for TES-heavy runs.
+
+Builds synthetic runs with many TES ROI columns, standing in for autoprocess
+output, and times get_run_data, get_xdi_normalized_data, generate_format_string
+and each exporter as the ROI count and the number of points grow. Each stage's
+scaling exponent is the log-log slope between its two largest sizes. The
+benchmark exits with status 1 if any stage scales worse than --max-exponent.
+"""
+
+import argparse
+import contextlib
+import io
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+from os.path import join
+
+import numpy as np
+import xarray as xr
+
+import export_to_athena
+import export_tools
+from export_to_athena import exportToAthena
+from export_to_hdf5 import exportToHDF5
+from export_to_quicklook import exportToQuicklook
+from export_to_xdi import (
+    exportToXDI,
+    generate_format_string,
+    get_xdi_normalized_data,
+    get_xdi_run_header,
+)
+from tiled_access import read_run
+
+STAGES = (
+    "get_run_data",
+    "get_xdi_normalized_data",
+    "generate_format_string",
+    "exportToXDI",
+    "exportToHDF5",
+    "exportToAthena",
+    "exportToQuicklook",
+)
+
+
+class SyntheticData:
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def keys(self):
+        return list(self.arrays)
+
+    def read(self, keys=None):
+        if keys is None:
+            keys = list(self.arrays)
+        return xr.Dataset({key: ("time", self.arrays[key]) for key in keys})
+
+
+class SyntheticStream:
+    def __init__(self, arrays, configuration):
+        self.data = SyntheticData(arrays)
+        data_keys = {key: {"shape": []} for key in arrays}
+        self.descriptors = [{"data_keys": data_keys, "configuration": configuration}]
+
+    def read(self):
+        return self.data.read()
+
+
+class SyntheticRun(dict):
+    """
+    A stand-in for a bluesky-tiled-plugins run with a primary and baseline stream,
+    carrying the TES ROIs and data that autoprocess would have produced for it.
+
+    Parameters
+    ----------
+    npts : int
+        Number of points in the primary stream.
+    nrois : int
+        Number of TES ROI columns, besides tes_mca_counts.
+    scan_id : int, optional
+        Used for the uid and to seed the random data.
+    """
+
+    def __init__(self, npts, nrois, scan_id=1):
+        rng = np.random.default_rng(scan_id)
+        energy = np.linspace(700.0, 740.0, npts)
+        primary = {
+            "en_energy_setpoint": energy,
+            "en_energy": energy + rng.normal(0, 0.01, npts),
+            "nexafs_i0up": rng.normal(1e-9, 1e-11, npts),
+            "nexafs_ref": rng.normal(1e-10, 1e-12, npts),
+            "nexafs_sc": rng.normal(1e-11, 1e-13, npts),
+            "time": 1.7e9 + np.arange(npts, dtype=float),
+        }
+        baseline = {
+            "NSLS-II Ring Current": np.array([400.0, 400.0]),
+            "eslit": np.array([20.0, 20.0]),
+            "manip_x": np.array([1.0, 1.0]),
+            "manip_y": np.array([2.0, 2.0]),
+            "manip_z": np.array([3.0, 3.0]),
+            "manip_r": np.array([45.0, 45.0]),
+            "tesz": np.array([10.0, 10.0]),
+        }
+        self.primary = SyntheticStream(
+            primary, {"nexafs_i0up": {"data": {"nexafs_i0up_exposure_time": 1.0}}}
+        )
+        self.baseline = SyntheticStream(
+            baseline, {"en": {"data": {"en_monoen_gratingx_setpoint": "Au"}}}
+        )
+        super().__init__(primary=self.primary, baseline=self.baseline)
+
+        self.rois = {"tes_mca_counts": (200.0, 1000.0)}
+        self.tes_data = {"tes_mca_counts": rng.poisson(1000, npts).astype(float)}
+        for i in range(nrois):
+            lo = 200.0 + 0.1 * i
+            self.rois[f"tes_roi{i}"] = (lo, lo + 0.1)
+            self.tes_data[f"tes_roi{i}"] = rng.poisson(10, npts).astype(float)
+
+        self.start = {
+            "uid": f"benchmark-{scan_id}-{npts}-{nrois}",
+            "scan_id": scan_id,
+            "time": 1.7e9,
+            "plan_name": "tes_scan",
+            "sample_name": "benchmark",
+            "sample_id": "1",
+            "motors": ["en_energy"],
+            "cycle": "2026-3",
+            "proposal": {"proposal_id": "000000", "type": "Commissioning"},
+            "start_datetime": "2026-10-19T00:00:00",
+        }
+
+
+def use_synthetic_tes_data():
+    """
+    Serve each SyntheticRun's own ROIs and TES data in place of autoprocess output,
+    and give the Athena exporter a logger that works outside a Prefect flow.
+    """
+    export_tools.run_is_processed = lambda run, save_directory: True
+    export_tools.get_tes_data = lambda run, save_directory, omit_array_keys=True: (
+        run.rois,
+        run.tes_data,
+    )
+    export_to_athena.get_run_logger = lambda: logging.getLogger(__name__)
+
+
+def best_time(func, repeat, setup=None):
+    """
+    Best time of repeat calls of func, each passed the result of setup, if given,
+    which is called outside the timing.
+    """
+    best = math.inf
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start_time = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def time_stages(run, export_path, repeat=3):
+    """
+    Time every stage on one run.
+
+    Returns
+    -------
+    dict
+        Mapping of stage name to its best time in seconds over repeat calls.
+    """
+    # The exporters report progress with print; keep it out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        return _time_stages(run, export_path, repeat)
+
+
+def _time_stages(run, export_path, repeat):
+    reads = read_run(run)
+    metadata = get_xdi_run_header(run, reads=reads)
+    columns, run_data, metadata = get_xdi_normalized_data(run, metadata, reads=reads)
+    loaded = {"columns": columns, "run_data": run_data, "metadata": metadata}
+
+    def new_folder(fmt):
+        # Every call exports into a new visit directory, so no call finds an
+        # identical file from an earlier one in the manifest and skips its write
+        def setup():
+            os.makedirs(export_path, exist_ok=True)
+            folder = join(tempfile.mkdtemp(dir=export_path), fmt)
+            os.mkdir(folder)
+            return folder
+
+        return setup
+
+    stages = {
+        "get_run_data": lambda: export_tools.get_run_data(
+            run, usekeys=reads["primary_keys"], data=reads["primary"]
+        ),
+        "get_xdi_normalized_data": lambda: get_xdi_normalized_data(
+            run, get_xdi_run_header(run, reads=reads), reads=reads
+        ),
+        "generate_format_string": lambda: generate_format_string(run_data),
+    }
+    exporters = {
+        "exportToXDI": ("xdi", lambda folder: exportToXDI(folder, run)),
+        "exportToHDF5": ("hdf5", lambda folder: exportToHDF5(folder, run)),
+        "exportToAthena": (
+            "athena",
+            lambda folder: exportToAthena(folder, run, **loaded),
+        ),
+        "exportToQuicklook": (
+            "quicklook",
+            lambda folder: exportToQuicklook(folder, run, **loaded),
+        ),
+    }
+    times = {}
+    for stage in STAGES:
+        if stage in exporters:
+            fmt, export = exporters[stage]
+            times[stage] = best_time(export, repeat, new_folder(fmt))
+        else:
+            times[stage] = best_time(stages[stage], repeat)
+    return times
+
+
+def scaling_exponent(sizes, times):
+    """
+    Log-log slope of time against size between the two largest sizes.
+    """
+    (n0, t0), (n1, t1) = sorted(zip(sizes, times))[-2:]
+    if n0 == n1 or t0 <= 0 or t1 <= 0:
+        return 0.0
+    return math.log(t1 / t0) / math.log(n1 / n0)
+
+
+def sweep(label, sizes, make_run, export_path, repeat=3):
+    """
+    Time every stage across sizes, print a table, and return each stage's exponent.
+
+    Parameters
+    ----------
+    label : str
+        What is being varied, for the table heading.
+    sizes : list of int
+        The sizes to run.
+    make_run : callable
+        Builds a SyntheticRun of a given size.
+    export_path : str
+        Visit directory the exporters write into.
+    repeat : int, optional
+        Number of timed calls per stage and size.
+
+    Returns
+    -------
+    dict
+        Mapping of stage name to its scaling exponent.
+    """
+    sizes = sorted(sizes)
+    timings = {stage: [] for stage in STAGES}
+    for size in sizes:
+        for stage, elapsed in time_stages(make_run(size), export_path, repeat).items():
+            timings[stage].append(elapsed)
+
+    print(f"\nScaling with {label}")
+    print(f"{'stage':<26}" + "".join(f"{n:>12}" for n in sizes) + "    exponent")
+    exponents = {}
+    for stage, times in timings.items():
+        exponents[stage] = scaling_exponent(sizes, times)
+        print(
+            f"{stage:<26}"
+            + "".join(f"{t * 1000:>10.1f}ms" for t in times)
+            + f"    {exponents[stage]:8.2f}"
+        )
+    return exponents
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the export stages against ROI count and point count"
+    )
+    parser.add_argument("--rois", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--points", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument(
+        "--fixed-points", type=int, default=500, help="points per run in the ROI sweep"
+    )
+    parser.add_argument(
+        "--fixed-rois", type=int, default=100, help="ROIs per run in the point sweep"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--max-exponent",
+        type=float,
+        default=1.3,
+        help="fail if any stage's time grows faster than size**max_exponent",
+    )
+    args = parser.parse_args()
+
+    use_synthetic_tes_data()
+    failures = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        export_path = join(tmpdir, "20261019_export")
+        sweeps = [
+            ("ROI count", args.rois, lambda n: SyntheticRun(args.fixed_points, n)),
+            ("point count", args.points, lambda n: SyntheticRun(n, args.fixed_rois)),
+        ]
+        for label, sizes, make_run in sweeps:
+            exponents = sweep(label, sizes, make_run, export_path, args.repeat)
+            for stage, exponent in exponents.items():
+                if exponent > args.max_exponent:
+                    failures.append(
+                        f"{stage} grows as ({label})**{exponent:.2f}, "
+                        f"above {args.max_exponent}"
+                    )
+    print()
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print(f"All stages grow no faster than size**{args.max_exponent}")
+    sys.exit(1 if failures else 0)
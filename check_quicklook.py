@@ -0,0 +1,113 @@
+"""
+Size and layout check of the quicklook export against the full HDF5 export.
+
+Exports synthetic TES runs of several sizes with exportToHDF5 and exportToQuicklook
+and checks that every quicklook file is smaller than the full HDF5 file, that
+short scans get a single undecimated level, and that no level has as many values
+as the scan it summarizes.
+
+    python check_quicklook.py --sizes 50x5 500x100 5000x100
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+from os.path import join
+
+import h5py
+
+from benchmark_roi_scaling import SyntheticRun, use_synthetic_tes_data
+from export_to_hdf5 import exportToHDF5
+from export_to_quicklook import exportToQuicklook
+from export_tools import MANIFEST_NAME
+
+
+def export_pair(run, export_path):
+    """
+    Export a run as HDF5 and quicklook.
+
+    Returns
+    -------
+    tuple
+        (HDF5 filename, quicklook filename)
+    """
+    filenames = []
+    for fmt, export in (("hdf5", exportToHDF5), ("quicklook", exportToQuicklook)):
+        folder = join(export_path, fmt)
+        os.makedirs(folder)
+        with contextlib.redirect_stdout(io.StringIO()):
+            export(folder, run, manifest_path=join(export_path, MANIFEST_NAME))
+        (name,) = os.listdir(folder)
+        filenames.append(join(folder, name))
+    return tuple(filenames)
+
+
+def check_run(npts, nrois, export_path):
+    """
+    Returns
+    -------
+    list of str
+        Descriptions of every problem found.
+    """
+    problems = []
+    hdf5_filename, quicklook_filename = export_pair(
+        SyntheticRun(npts, nrois), export_path
+    )
+    hdf5_size = os.path.getsize(hdf5_filename)
+    quicklook_size = os.path.getsize(quicklook_filename)
+    print(
+        f"{npts} points, {nrois} ROIs: HDF5 {hdf5_size:_} bytes, "
+        f"quicklook {quicklook_size:_} bytes"
+    )
+    if quicklook_size >= hdf5_size:
+        problems.append(
+            f"{npts}x{nrois}: quicklook ({quicklook_size:_} bytes) is not smaller "
+            f"than the HDF5 export ({hdf5_size:_} bytes)"
+        )
+    with h5py.File(quicklook_filename, "r") as f:
+        levels = [name for name in f if name.startswith("level_")]
+        if "raw" in f and levels:
+            problems.append(f"{npts}x{nrois}: raw level written beside {levels}")
+        if "raw" not in f and not levels:
+            problems.append(f"{npts}x{nrois}: no quicklook level written")
+        for name in levels:
+            values = max(dataset.size for dataset in f[name].values())
+            if values >= npts:
+                problems.append(
+                    f"{npts}x{nrois}: {name} stores {values} values for {npts} points"
+                )
+    return problems
+
+
+def parse_size(value):
+    npts, nrois = value.split("x")
+    return int(npts), int(nrois)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check quicklook exports are smaller than the full HDF5 export"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=parse_size,
+        nargs="+",
+        default=[(50, 5), (100, 0), (500, 100), (5000, 100), (20000, 10)],
+        help="runs to export, as <points>x<ROIs>",
+    )
+    args = parser.parse_args()
+
+    use_synthetic_tes_data()
+    problems = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i, (npts, nrois) in enumerate(args.sizes):
+            problems += check_run(npts, nrois, join(tmpdir, f"visit{i}"))
+
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if not problems:
+        print("Quicklook exports are smaller than the HDF5 exports")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,226 @@
+"""
+Round-trip check of the tiled writeback against an in-process Tiled server.
+
+Uploads a synthetic TES dataset with many ROI columns, a RIXS spectrum and a RIXS
+map into a temporary sqlite-backed catalog, reads everything back and compares
+it, and checks that only completed scans are skipped by later batches. Also
+uploads a batch of small scans as one table, checks that each scan reads back
+from it, and checks the backoff for runs that keep failing.
+
+    python check_tiled_writeback.py --rois 1000 --points 500
+"""
+
+import argparse
+import logging
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+
+import numpy as np
+from tiled.catalog import from_uri
+from tiled.client import Context, from_context
+from tiled.server.app import build_app
+
+from export_to_tiled import add_rixs_maps, build_dataset
+from tiled_writeback import (
+    COLUMNS_KEY,
+    COMPLETE_KEY,
+    FAILURE_BACKOFF_SECONDS,
+    FAILURES_KEY,
+    STARTED_KEY,
+    get_batch_key,
+    get_batch_schema,
+    get_writeback_state,
+    is_backing_off,
+    is_complete,
+    is_written_back,
+    mark_complete,
+    read_scan_table,
+    remove_partial_writeback,
+    submit_dataset,
+    update_failures,
+    upload_batch,
+)
+
+
+def make_dataset(npts, nrois, nemission=50):
+    rng = np.random.default_rng(0)
+    columns = ["energy", "i0"] + [f"tes_roi{i}" for i in range(nrois)]
+    run_data = [np.linspace(700.0, 740.0, npts), rng.normal(1.0, 0.01, npts)]
+    run_data += [rng.poisson(10, npts) for _ in range(nrois)]
+    columns += ["rixs", "time"]
+    run_data += [
+        rng.poisson(5, (npts, nemission)).astype(float),
+        1.7e9 + np.arange(npts, dtype=float),
+    ]
+    ds = build_dataset(columns, run_data)
+    add_rixs_maps(
+        ds,
+        [
+            {
+                "counts": rng.random((20, nemission)),
+                "incident_energies": np.linspace(700.0, 740.0, 20),
+                "emission_energies": np.arange(nemission, dtype=float),
+                "incident_width": 2.0,
+                "emission_width": 1.0,
+            }
+        ],
+    )
+    return ds
+
+
+def check_roundtrip(container, ds, chunk_nbytes):
+    """
+    Upload ds as one scan and compare what is read back.
+
+    Returns
+    -------
+    list of str
+        Descriptions of every mismatch.
+    """
+    problems = []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = submit_dataset(
+            container, "scan", ds, {"scan": 1}, executor, chunk_nbytes
+        )
+        nrequests = sum(f.result() for f in futures)
+    if is_complete(container, "scan"):
+        problems.append("scan marked complete before mark_complete")
+    mark_complete(container, "scan")
+    if not is_complete(container, "scan"):
+        problems.append("scan not marked complete")
+    print(f"Uploaded {len(ds.variables)} variables in {nrequests} requests")
+
+    node = container["scan"]
+    table = node[COLUMNS_KEY].read()
+    for name, variable in ds.variables.items():
+        if variable.dims == ("time",):
+            actual = table[name].to_numpy()
+        else:
+            actual = node[name].read()
+        if not np.array_equal(np.asarray(actual), np.asarray(variable.data)):
+            problems.append(f"{name} differs after the round trip")
+    if node.metadata.get("scan") != 1:
+        problems.append("scan metadata was not kept")
+    return problems
+
+
+def check_batch(container, nscans, npts):
+    """
+    Upload small scans as one batch table and read each one back.
+    """
+    problems = []
+    scans = []
+    for i in range(nscans):
+        ds = build_dataset(
+            ["energy", "i0", "tes_mca_counts", "time"],
+            [
+                np.linspace(700.0, 740.0, npts + i),
+                np.full(npts + i, float(i)),
+                np.arange(npts + i),
+                1.7e9 + np.arange(npts + i, dtype=float),
+            ],
+        )
+        scans.append((f"small{i}", ds, {"scan_id": i}))
+    if len({get_batch_schema(ds) for _, ds, _ in scans} - {None}) != 1:
+        problems.append("small scans were not given one batch schema")
+    key = get_batch_key(scans)
+    nrequests = upload_batch(container, key, scans)
+    mark_complete(container, key)
+    print(f"Uploaded {nscans} small scans in {nrequests + 1} requests")
+    for uid, ds, _ in scans:
+        table = read_scan_table(container, uid)
+        for name in table.columns:
+            if not np.array_equal(table[name].to_numpy(), ds.variables[name].data):
+                problems.append(f"{name} of {uid} differs after the batch round trip")
+        if not is_written_back(container, uid):
+            problems.append(f"{uid} not found as written back")
+    if container[key].metadata["scans"]["small1"]["metadata"]["scan_id"] != 1:
+        problems.append("batch scan metadata was not kept")
+    complete, _ = get_writeback_state(container, time.time() - 3600)
+    if not {uid for uid, _, _ in scans} <= complete:
+        problems.append("batched scans missing from the writeback state")
+    return problems
+
+
+def check_backoff(container):
+    """
+    A run that keeps failing waits longer after each failure, and is forgotten
+    once it is uploaded.
+    """
+    problems = []
+    logger = logging.getLogger(__name__)
+    now = time.time()
+    update_failures(container, {}, ["bad"], [], now - 3600, now, logger)
+    failures = {uid: dict(f) for uid, f in container.metadata[FAILURES_KEY].items()}
+    if not is_backing_off(failures["bad"], now + FAILURE_BACKOFF_SECONDS / 2):
+        problems.append("failed run retried before its backoff")
+    if is_backing_off(failures["bad"], now + FAILURE_BACKOFF_SECONDS + 1):
+        problems.append("failed run not retried after its backoff")
+    later = now + FAILURE_BACKOFF_SECONDS + 1
+    update_failures(container, failures, ["bad"], [], now - 3600, later, logger)
+    failures = {uid: dict(f) for uid, f in container.metadata[FAILURES_KEY].items()}
+    if not is_backing_off(failures["bad"], later + FAILURE_BACKOFF_SECONDS + 1):
+        problems.append("backoff did not grow after a second failure")
+    update_failures(container, failures, [], ["bad"], now - 3600, later, logger)
+    if container.metadata[FAILURES_KEY]:
+        problems.append("uploaded run still recorded as failing")
+    return problems
+
+
+def check_partial(container):
+    """
+    A scan left without the completion marker is not treated as written back.
+    """
+    problems = []
+    container.create_container(
+        "partial", metadata={COMPLETE_KEY: False, STARTED_KEY: time.time()}
+    )
+    if is_complete(container, "partial"):
+        problems.append("partial scan treated as complete")
+    _, partial = get_writeback_state(container, time.time() - 3600)
+    if "partial" not in partial:
+        problems.append("partial scan missing from the writeback state")
+    remove_partial_writeback(container, "partial", logging.getLogger(__name__))
+    if "partial" in container:
+        problems.append("partial scan was not removed")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the tiled writeback against an in-process Tiled server"
+    )
+    parser.add_argument("--rois", type=int, default=1000)
+    parser.add_argument("--points", type=int, default=500)
+    parser.add_argument(
+        "--chunk-nbytes",
+        type=int,
+        default=1_000_000,
+        help="small enough that the table is split into several partitions",
+    )
+    parser.add_argument("--small-scans", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        adapter = from_uri(
+            f"sqlite:///{join(tmpdir, 'catalog.db')}",
+            writable_storage=join(tmpdir, "data"),
+            init_if_not_exists=True,
+        )
+        with Context.from_app(build_app(adapter)) as context:
+            container = from_context(context).create_container("processed")
+            problems = check_roundtrip(
+                container, make_dataset(args.points, args.rois), args.chunk_nbytes
+            )
+            problems += check_partial(container)
+            problems += check_batch(container, args.small_scans, 50)
+            problems += check_backoff(container)
+
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if not problems:
+        print("Writeback round trip OK")
+    sys.exit(1 if problems else 0)
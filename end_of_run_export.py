@@ -1,34 +1,164 @@
 from prefect import flow, get_run_logger, task
-from os.path import exists, join
-import os
+from prefect.cache_policies import NONE
+from os.path import join
 from export_to_xdi import exportToXDI
 from export_to_hdf5 import exportToHDF5
-from export_tools import get_proposal_path, initialize_tiled_client
-import datetime
+from export_to_athena import exportToAthena
+from export_to_quicklook import exportToQuicklook
+from export_layout import (
+    create_export_path,
+    create_export_paths,
+    get_export_path,
+    invalidate_export_path,
+    record_export,
+)
+from export_tools import MANIFEST_NAME, initialize_tiled_client
+from tiled_access import read_run
 
+EXPORTERS = {
+    "xdi": exportToXDI,
+    "hdf5": exportToHDF5,
+    "athena": exportToAthena,
+    "quicklook": exportToQuicklook,
+}
 
-def get_export_path(run):
-    proposal_path = get_proposal_path(run)
+# Formats written from the data already loaded for another format
+COMPANIONS = {
+    "xdi": ("athena",),
+    "hdf5": ("quicklook",),
+}
 
-    visit_date = datetime.datetime.fromisoformat(
-        run.start.get("start_datetime", datetime.datetime.today().isoformat())
-    )
-    visit_dir = visit_date.strftime("%Y%m%d_export")
+DEFAULT_FORMATS = ("xdi", "hdf5", "athena", "quicklook")
+
+# Formats that export array keys, such as the TES MCA spectrum
+ARRAY_FORMATS = ("hdf5", "quicklook")
+
+
+# The run data passed in is not hashed for a cache key; exports are never cached
+@task(retries=2, retry_delay_seconds=10, cache_policy=NONE)
+def export_format(
+    uid,
+    fmt,
+    base_export_path,
+    beamline_acronym="ucal",
+    companions=(),
+    compress_xdi=False,
+    rixs_bin_widths=None,
+    reads=None,
+):
+    """
+    Export a run in a single format.
+
+    Each format is its own task, so a retry only redoes the format that failed.
+
+    Parameters
+    ----------
+    uid : str
+        Unique identifier for the run to export
+    fmt : str
+        One of the keys of EXPORTERS
+    base_export_path : str
+        The visit export directory; the file goes in a subdirectory named after the format
+    beamline_acronym : str, optional
+        Beamline identifier
+    companions : tuple of str, optional
+        Formats from COMPANIONS[fmt] to write from the data already loaded for fmt
+    compress_xdi : bool, optional
+        If True, write gzip-compressed XDI
+    rixs_bin_widths : list of (float, float), optional
+        (incident, emission) bin widths of the RIXS maps in the HDF5 export, one
+        pair per map. Defaults to multiples of the native spacing.
+    reads : dict, optional
+        The run data from read_export_data, shared by every format. If None, the
+        exporter reads the run itself.
+    """
+    logger = get_run_logger()
+    catalog = initialize_tiled_client(beamline_acronym)
+    run = catalog[uid]
 
-    export_path = join(proposal_path, visit_dir)
-    return export_path
+    logger.info(f"Exporting {fmt.upper()}")
+    format_export_path = join(base_export_path, fmt)
+    create_export_path(format_export_path)
+    # Every format of the visit is recorded in one manifest, read by record_export
+    manifest_path = join(base_export_path, MANIFEST_NAME)
+    try:
+        if fmt == "xdi":
+            exported = exportToXDI(
+                format_export_path,
+                run,
+                compress=compress_xdi,
+                manifest_path=manifest_path,
+                reads=reads,
+            )
+        elif fmt == "hdf5":
+            exported = exportToHDF5(
+                format_export_path,
+                run,
+                rixs_bin_widths=rixs_bin_widths,
+                manifest_path=manifest_path,
+                reads=reads,
+            )
+        else:
+            exported = EXPORTERS[fmt](
+                format_export_path, run, manifest_path=manifest_path, reads=reads
+            )
+        if not exported:
+            return
+        log_export_count(base_export_path, fmt)
+        if not companions:
+            return
+        columns, run_data, metadata = exported
+        for companion in companions:
+            logger.info(f"Exporting {companion.upper()}")
+            companion_export_path = join(base_export_path, companion)
+            create_export_path(companion_export_path)
+            EXPORTERS[companion](
+                companion_export_path,
+                run,
+                columns=columns,
+                run_data=run_data,
+                metadata=metadata,
+                manifest_path=manifest_path,
+            )
+            log_export_count(base_export_path, companion)
+    except FileNotFoundError:
+        # The directory may have been removed since it was cached; check again on retry
+        invalidate_export_path(base_export_path)
+        raise
 
 
-def create_export_path(export_path):
+def log_export_count(base_export_path, fmt):
     logger = get_run_logger()
-    export_path_exists = exists(export_path)
-    if not export_path_exists:
-        os.makedirs(export_path, exist_ok=True)
-        logger.info(f"Export path does not exist, making {export_path}")
+    nfiles = record_export(base_export_path, fmt)
+    logger.info(f"{base_export_path} has {nfiles} {fmt} files")
+
+
+def read_export_data(run, formats):
+    """
+    Read a run once for every format being exported.
 
+    Array keys are only read if one of the formats exports them.
 
-@task(retries=2, retry_delay_seconds=10)
-def export_all_streams(uid, beamline_acronym="ucal"):
+    Returns
+    -------
+    dict or None
+        The data from tiled_access.read_run, or None if the run has no primary
+        stream, which the exporters skip.
+    """
+    if "primary" not in run:
+        return None
+    omit_array_keys = not any(fmt in ARRAY_FORMATS for fmt in formats)
+    return read_run(run, omit_array_keys=omit_array_keys)
+
+
+@task
+def export_all_streams(
+    uid,
+    beamline_acronym="ucal",
+    formats=DEFAULT_FORMATS,
+    compress_xdi=False,
+    rixs_bin_widths=None,
+):
     logger = get_run_logger()
     catalog = initialize_tiled_client(beamline_acronym)
     run = catalog[uid]
@@ -36,20 +166,42 @@ def export_all_streams(uid, beamline_acronym="ucal"):
     base_export_path = get_export_path(run)
     logger.info(f"Generating Export for uid {run.start['uid']}")
     logger.info(f"Export Data to {base_export_path}")
-    create_export_path(base_export_path)
+    create_export_paths(base_export_path, formats)
+    reads = read_export_data(run, formats)
 
-    logger.info("Exporting XDI")
-    xdi_export_path = join(base_export_path, "xdi")
-    create_export_path(xdi_export_path)
-    exportToXDI(xdi_export_path, run)
-    logger.info("Exporting HDF5")
-    hdf5_export_path = join(base_export_path, "hdf5")
-    create_export_path(hdf5_export_path)
-    exportToHDF5(hdf5_export_path, run)
-    # logger.info("Exporting Athena")
-    # exportToAthena(export_path, run)
+    # Companion formats share the data loaded for their parent format
+    companions = {}
+    shared = set()
+    for fmt in formats:
+        companions[fmt] = tuple(c for c in COMPANIONS.get(fmt, ()) if c in formats)
+        shared.update(companions[fmt])
+    for fmt in formats:
+        if fmt in shared:
+            continue
+        export_format(
+            uid,
+            fmt,
+            base_export_path,
+            beamline_acronym,
+            companions=companions[fmt],
+            compress_xdi=compress_xdi,
+            rixs_bin_widths=rixs_bin_widths,
+            reads=reads,
+        )
 
 
 @flow
-def general_data_export(uid, beamline_acronym="ucal"):
-    export_all_streams(uid, beamline_acronym)
+def general_data_export(
+    uid,
+    beamline_acronym="ucal",
+    formats=DEFAULT_FORMATS,
+    compress_xdi=False,
+    rixs_bin_widths=None,
+):
+    export_all_streams(
+        uid,
+        beamline_acronym,
+        formats=formats,
+        compress_xdi=compress_xdi,
+        rixs_bin_widths=rixs_bin_widths,
+    )
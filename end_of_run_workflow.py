@@ -1,6 +1,6 @@
 from prefect import flow, get_run_logger, task
 from data_validation import general_data_validation
-from end_of_run_export import general_data_export
+from end_of_run_export import DEFAULT_FORMATS, general_data_export
 from process_tes import process_tes
 from export_tools import initialize_tiled_client
 
@@ -11,24 +11,68 @@ def log_completion():
     logger.info("Complete")
 
 
+def plan_end_of_run(run, stop_doc):
+    """
+    Decide which workflow stages apply to a run before any stream data is read.
+
+    Only the start document, the stop document, and the list of streams are
+    consulted, so aborted and sessionless runs skip the expensive reads.
+
+    Parameters
+    ----------
+    run : Run
+        The run to plan for.
+    stop_doc : dict
+        The stop document that triggered the workflow.
+
+    Returns
+    -------
+    dict
+        The plan, with keys "validation" ("full" or "lite"), "process_tes" (bool),
+        "export_formats" (list of str), "exit_status", and "skip_reason" (why
+        the run is not processed and exported, or None).
+    """
+    exit_status = stop_doc.get("exit_status", "No Status")
+    has_session = run.start.get("data_session", "") != ""
+    has_primary = "primary" in list(run)
+    if not has_session:
+        skip_reason = "No data session found"
+    elif exit_status != "success":
+        skip_reason = f"Run had exit status: {exit_status}"
+    elif not has_primary:
+        skip_reason = "Run has no primary stream"
+    else:
+        skip_reason = None
+    do_export = skip_reason is None
+
+    plan = {}
+    plan["exit_status"] = exit_status
+    plan["skip_reason"] = skip_reason
+    plan["validation"] = "full" if do_export else "lite"
+    # TES processing reads the full TES data, which is only worth it for runs
+    # that will be exported
+    plan["process_tes"] = do_export
+    plan["export_formats"] = list(DEFAULT_FORMATS) if do_export else []
+    return plan
+
+
 @flow
 def end_of_run_workflow(stop_doc, reprocess_tes=False):
     uid = stop_doc["run_start"]
     logger = get_run_logger()
 
-    general_data_validation(uid)
     catalog = initialize_tiled_client("ucal")
     run = catalog[uid]
-    if run.start.get("data_session", "") == "":
-        logger.info("No data session found, skipping export")
-        return
+    plan = plan_end_of_run(run, stop_doc)
+    logger.info(f"Workflow plan: {plan}")
 
-    process_tes(uid, reprocess=reprocess_tes)
+    general_data_validation(uid, lite=(plan["validation"] == "lite"))
+    if plan["process_tes"]:
+        process_tes(uid, reprocess=reprocess_tes)
     # Here is where exporters could be added
-    exit_status = stop_doc.get("exit_status", "No Status")
-    if exit_status == "success":
-        general_data_export(uid)
+    if plan["export_formats"]:
+        general_data_export(uid, formats=plan["export_formats"])
     else:
-        logger.info(f"Run had exit status: {exit_status}, skipping export")
+        logger.info(f"{plan['skip_reason']}, skipping export")
 
     log_completion()
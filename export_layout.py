@@ -0,0 +1,117 @@
+import datetime
+import os
+import time
+from os.path import dirname, exists, join
+
+from prefect import get_run_logger
+
+from export_tools import MANIFEST_NAME, get_manifest_index, get_proposal_path
+
+# Seconds a directory is trusted to exist before it is checked on disk again
+KNOWN_PATH_TTL_SECONDS = 600
+
+# Directories known to exist, mapped to the time they were last confirmed. Each
+# run gets a new worker process, so this saves the repeated checks within a run,
+# e.g. of the visit and format directories by each export_format task.
+_known_paths = {}
+
+
+def get_export_path(run):
+    proposal_path = get_proposal_path(run)
+
+    visit_date = datetime.datetime.fromisoformat(
+        run.start.get("start_datetime", datetime.datetime.today().isoformat())
+    )
+    visit_dir = visit_date.strftime("%Y%m%d_export")
+
+    export_path = join(proposal_path, visit_dir)
+    return export_path
+
+
+def _mark_known(path, now):
+    # A directory existing implies its parents exist too
+    while path and path not in ("/", "."):
+        _known_paths[path] = now
+        parent = dirname(path.rstrip("/"))
+        if parent == path:
+            break
+        path = parent
+
+
+def create_export_path(export_path):
+    """
+    Make sure an export directory exists, touching the filesystem at most once per
+    KNOWN_PATH_TTL_SECONDS for each directory.
+    """
+    now = time.monotonic()
+    if now - _known_paths.get(export_path, -KNOWN_PATH_TTL_SECONDS) < (
+        KNOWN_PATH_TTL_SECONDS
+    ):
+        return
+    if not exists(export_path):
+        logger = get_run_logger()
+        os.makedirs(export_path, exist_ok=True)
+        logger.info(f"Export path does not exist, making {export_path}")
+    _mark_known(export_path, now)
+
+
+def create_export_paths(base_export_path, subdirs):
+    """
+    Make sure a visit directory and its format subdirectories exist.
+
+    Only the subdirectories are checked, since creating them creates the visit
+    directory too.
+
+    Parameters
+    ----------
+    base_export_path : str
+        The visit export directory.
+    subdirs : iterable of str
+        Subdirectory names, normally the export formats.
+
+    Returns
+    -------
+    dict
+        Mapping of subdirectory name to its full path.
+    """
+    paths = {subdir: join(base_export_path, subdir) for subdir in subdirs}
+    for path in paths.values():
+        create_export_path(path)
+    if not paths:
+        create_export_path(base_export_path)
+    return paths
+
+
+def invalidate_export_path(export_path):
+    """
+    Forget cached state for a directory and everything below it, e.g. after a write
+    into it failed because it had been removed.
+    """
+    prefix = export_path.rstrip("/") + "/"
+    for path in list(_known_paths):
+        if path == export_path or path.startswith(prefix):
+            del _known_paths[path]
+
+
+def record_export(base_export_path, fmt):
+    """
+    Get the number of files of one format in a visit directory.
+
+    The count comes from the visit manifest index that the exports already keep,
+    so it costs no directory listing. Every path exported into the format
+    directory counts once, however often it is overwritten or left unchanged.
+
+    Parameters
+    ----------
+    base_export_path : str
+        The visit export directory.
+    fmt : str
+        The format subdirectory.
+
+    Returns
+    -------
+    int
+        The number of files of that format in the visit directory.
+    """
+    index = get_manifest_index(join(base_export_path, MANIFEST_NAME))
+    return index["counts"].get(fmt, 0)
@@ -1,7 +1,37 @@
-import numpy as np
 from os.path import join
-from export_tools import add_comment_to_lines, get_header_and_data
+from export_tools import add_comment_to_lines, checksummed_open, write_columns
+from export_to_xdi import get_xdi_normalized_data, get_xdi_run_header
 from prefect import get_run_logger
+from tiled_access import read_run
+
+
+def get_athena_header(metadata):
+    """
+    Build the Athena 'scaninfo' and 'motors' dictionaries from an XDI header.
+
+    Parameters
+    ----------
+    metadata : dict
+        The XDI header, as returned by get_xdi_run_header.
+
+    Returns
+    -------
+    dict
+        Dictionary with 'scaninfo' and 'motors' sub-dictionaries.
+    """
+    scaninfo = {}
+    scaninfo["scan"] = metadata.get("Scan.transient_id", "")
+    scaninfo["date"] = metadata.get("Scan.start_time", "")
+    scaninfo["sample"] = metadata.get("Sample.name", "")
+    scaninfo["loadid"] = metadata.get("Sample.id", "")
+    scaninfo["command"] = metadata.get("Scan.command", "")
+    scaninfo["motor"] = metadata.get("Scan.motors", "time")
+    scaninfo["uid"] = metadata.get("Scan.uid", "")
+    motors = {}
+    for key, value in metadata.items():
+        if key.startswith("Motors."):
+            motors[key.split(".", 1)[1]] = value
+    return {"scaninfo": scaninfo, "motors": motors}
 
 
 def exportToAthena(
@@ -13,33 +43,54 @@ def exportToAthena(
     headerUpdates={},
     strict=False,
     verbose=True,
+    columns=None,
+    run_data=None,
+    metadata=None,
+    manifest_path=None,
+    reads=None,
 ):
     """Exports to Graham's ASCII SSRL data format
 
     :param folder: Export folder (filename will be auto-generated)
-    :param data: NumPy array with data of dimensions (npts, ncols)
-    :param header: Dictionary with 'scaninfo', 'motors', 'channelinfo' sub-dictionaries
+    :param run: The run to export
     :param namefmt: Python format string that will be filled with info from 'scaninfo' dictionary
     :param c1: Comment string 1
     :param c2: Comment string 2
     :param headerUpdates: Manual updates for header dictionary (helpful to fill missing info)
+    :param columns: Column names already loaded by exportToXDI, to avoid reading the run again
+    :param run_data: Column data already loaded by exportToXDI
+    :param metadata: XDI header already loaded by exportToXDI
+    :param manifest_path: Export manifest to record the file in; defaults to one in folder
+    :param reads: Data already read by tiled_access.read_run, used if columns are not given
     :returns:
     :rtype:
 
     """
     logger = get_run_logger()
-    logger.info("Getting athena header and data")
-    header, data = get_header_and_data(run)
+    if columns is None or run_data is None or metadata is None:
+        if "primary" not in run:
+            logger.info(
+                f"Athena Export does not support streams other than Primary, skipping {run.start['scan_id']}"
+            )
+            return False
+        logger.info("Getting athena header and data")
+        if reads is None:
+            reads = read_run(run)
+        metadata = get_xdi_run_header(run, reads=reads)
+        columns, run_data, metadata = get_xdi_normalized_data(
+            run, metadata, reads=reads
+        )
+    header = get_athena_header(metadata)
 
     filename = join(folder, namefmt.format(**header["scaninfo"]))
 
-    metadata = {}
-    metadata.update(header["scaninfo"])
-    metadata.update(headerUpdates)
+    scaninfo = {}
+    scaninfo.update(header["scaninfo"])
+    scaninfo.update(headerUpdates)
     if strict:
         # Scan can't be list, just pick first value
-        if isinstance(metadata["scan"], (list, tuple)):
-            metadata["scan"] = metadata["scan"][0]
+        if isinstance(scaninfo["scan"], (list, tuple)):
+            scaninfo["scan"] = scaninfo["scan"][0]
 
     motors = {
         "exslit": 0,
@@ -47,17 +98,19 @@ def exportToAthena(
         "sampley": 0,
         "samplez": 0,
         "sampler": 0,
+        "manipx": 0,
+        "manipy": 0,
+        "manipz": 0,
+        "manipr": 0,
     }
     motors.update(header["motors"])
-    channelinfo = header["channelinfo"]
-    cols = channelinfo.get("cols")
-    colStr = " ".join(cols)
+    colStr = " ".join(columns)
 
-    metadata["npts"] = data.shape[0]
-    metadata["ncols"] = data.shape[1]
-    metadata["cols"] = colStr
-    metadata["c1"] = c1
-    metadata["c2"] = c2
+    scaninfo["npts"] = len(run_data[0]) if len(run_data) > 0 else 0
+    scaninfo["ncols"] = len(columns)
+    scaninfo["cols"] = colStr
+    scaninfo["c1"] = c1
+    scaninfo["c2"] = c2
 
     headerstring = """NSLS
 {date}
@@ -71,10 +124,13 @@ Scan: {scan}
 {c1}
 {c2}
 -------------------------------------------------------------------------------
-{cols}""".format(**metadata, **motors)
+{cols}""".format(**scaninfo, **motors)
     headerstring = add_comment_to_lines(headerstring, "#")
     logger.info(f"Writing Athena to {filename}")
-    with open(filename, "w") as f:
+    with checksummed_open(
+        filename, "w", uid=run.start["uid"], manifest_path=manifest_path
+    ) as f:
         f.write(headerstring)
         f.write("\n")
-        np.savetxt(f, data, fmt=" %8.8e")
+        write_columns(f, run_data, " %8.8e")
+    return True
@@ -1,9 +1,20 @@
 import h5py
+import io
 
+from export_tools import write_checksummed_bytes
+from tiled_access import read_run
 from export_to_xdi import get_xdi_normalized_data, get_xdi_run_header, make_filename
+from rixs_tools import is_rixs_grid, make_rixs_maps
 
 
-def exportToHDF5(folder, run, header_updates={}):
+def exportToHDF5(
+    folder,
+    run,
+    header_updates={},
+    rixs_bin_widths=None,
+    manifest_path=None,
+    reads=None,
+):
     """
     Export a run to an HDF5 file.
 
@@ -11,6 +22,23 @@ def exportToHDF5(folder, run, header_updates={}):
     ----------
     run : Run
     folder : str
+    rixs_bin_widths : list of (float, float), optional
+        (incident, emission) bin widths of the RIXS maps, one pair per map.
+        Defaults to multiples of the native spacing from make_rixs_maps.
+    manifest_path : str, optional
+        Export manifest to record the file in. Defaults to one in `folder`.
+    reads : dict, optional
+        Data already read by tiled_access.read_run with omit_array_keys=False, to
+        avoid reading the run again.
+
+    Returns
+    -------
+    columns : list
+        The exported column names.
+    run_data : list
+        The exported column data.
+    metadata : dict
+        The exported header.
     """
 
     if "primary" not in run:
@@ -18,19 +46,23 @@ def exportToHDF5(folder, run, header_updates={}):
             f"HDF5 Export does not support streams other than Primary, skipping {run.start['scan_id']}"
         )
         return False
-    metadata = get_xdi_run_header(run, header_updates)
+    if reads is None:
+        reads = read_run(run, omit_array_keys=False)
+    metadata = get_xdi_run_header(run, header_updates, reads=reads)
     print("Got XDI Metadata")
     filename = make_filename(folder, metadata, "hdf5")
     print(f"Exporting HDF5 to {filename}")
 
     columns, run_data, metadata = get_xdi_normalized_data(
-        run, metadata, omit_array_keys=False
+        run, metadata, omit_array_keys=False, reads=reads
     )
 
-    with h5py.File(filename, "w") as f:
+    # Build the file in memory so it can be checksummed as it is written out
+    buffer = io.BytesIO()
+    with h5py.File(buffer, "w") as f:
         for name, data in zip(columns, run_data):
             if name == "rixs":
-                if len(data) == 3:
+                if is_rixs_grid(data):
                     counts, mono_grid, energy_grid = data
                     g = f.create_group("rixs")
                     g.create_dataset("motor_values", data=mono_grid[0, :])
@@ -40,7 +72,26 @@ def exportToHDF5(folder, run, header_updates={}):
                     f.create_dataset(name, data=data)
             else:
                 f.create_dataset(name, data=data)
+        rixs_maps = make_rixs_maps(
+            columns, run_data, metadata, bin_widths=rixs_bin_widths
+        )
+        if rixs_maps:
+            g = f.create_group("rixs_maps")
+            for level, rixs_map in enumerate(rixs_maps):
+                lg = g.create_group(f"level_{level}")
+                lg.create_dataset("counts", data=rixs_map["counts"])
+                lg.create_dataset(
+                    "incident_energies", data=rixs_map["incident_energies"]
+                )
+                lg.create_dataset(
+                    "emission_energies", data=rixs_map["emission_energies"]
+                )
+                lg.attrs["incident_width"] = rixs_map["incident_width"]
+                lg.attrs["emission_width"] = rixs_map["emission_width"]
         for key, value in metadata.items():
             f.attrs[key] = value
+    write_checksummed_bytes(
+        filename, buffer.getbuffer(), uid=run.start["uid"], manifest_path=manifest_path
+    )
 
-    return True
+    return columns, run_data, metadata
@@ -0,0 +1,205 @@
+import h5py
+import io
+import numpy as np
+
+from export_tools import write_checksummed_bytes
+from tiled_access import read_run
+from export_to_xdi import get_xdi_normalized_data, get_xdi_run_header, make_filename
+from rixs_tools import make_rixs_maps
+
+# Number of bins at each quicklook level, from finest to coarsest. A level is
+# only written if its min/max pairs are fewer values than the scan has points.
+QUICKLOOK_LEVELS = (1024, 256, 64)
+# Datasets smaller than this are stored contiguously, as gzip chunking adds more
+# than it saves for them
+QUICKLOOK_COMPRESS_NBYTES = 16384
+# Precision of the stored quicklook values, which are only for viewing
+QUICKLOOK_DTYPE = np.float32
+# RIXS map levels start with neither axis exceeding RIXS_MAX_SIZE, and are binned
+# 2x coarser until neither axis exceeds RIXS_MIN_SIZE
+RIXS_MAX_SIZE = 256
+RIXS_MIN_SIZE = 32
+QUICKLOOK_RIXS_RESOLUTIONS = (1, 2, 4, 8, 16)
+
+
+def minmax_decimate(data, nbins):
+    """
+    Downsample a 1-D array to per-bin minimum and maximum values.
+
+    Keeping both extremes of each bin preserves peaks and glitches that a plain
+    stride or mean would hide. NaNs are ignored.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The 1-D array to downsample.
+    nbins : int
+        The number of bins. Arrays with fewer points are returned unbinned.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (nbins, 2) with the minimum and maximum of each bin.
+    """
+    data = np.asarray(data, dtype=float)
+    if len(data) <= nbins:
+        return np.stack([data, data], axis=1)
+    edges = np.linspace(0, len(data), nbins + 1).astype(int)[:-1]
+    return np.stack(
+        [np.fmin.reduceat(data, edges), np.fmax.reduceat(data, edges)], axis=1
+    )
+
+
+def get_quicklook_levels(npts, levels=QUICKLOOK_LEVELS):
+    """
+    The levels that make a scan smaller: those with fewer than npts / 2 bins, as
+    each bin stores two values.
+    """
+    return [nbins for nbins in levels if 2 * nbins < npts]
+
+
+def create_quicklook_dataset(group, name, data):
+    """
+    Store quicklook values, compressing only datasets large enough to benefit.
+    """
+    data = np.asarray(data, dtype=QUICKLOOK_DTYPE)
+    if data.nbytes >= QUICKLOOK_COMPRESS_NBYTES:
+        return group.create_dataset(name, data=data, compression="gzip")
+    return group.create_dataset(name, data=data)
+
+
+def quicklook_rixs_maps(columns, run_data, metadata):
+    """
+    Regrid RIXS data into a pyramid of maps, each half the resolution of the one
+    before, from at most RIXS_MAX_SIZE bins per axis down to RIXS_MIN_SIZE.
+
+    Returns
+    -------
+    list of dict
+        Maps as returned by make_rixs_maps, finest first.
+    """
+    maps = make_rixs_maps(
+        columns,
+        run_data,
+        metadata,
+        resolutions=QUICKLOOK_RIXS_RESOLUTIONS,
+        max_bins=RIXS_MAX_SIZE,
+    )
+    pyramid = []
+    for rixs_map in maps:
+        pyramid.append(rixs_map)
+        if max(rixs_map["counts"].shape) <= RIXS_MIN_SIZE:
+            break
+    return pyramid
+
+
+def exportToQuicklook(
+    folder,
+    run,
+    header_updates={},
+    columns=None,
+    run_data=None,
+    metadata=None,
+    levels=QUICKLOOK_LEVELS,
+    manifest_path=None,
+    reads=None,
+):
+    """
+    Export a small, decimated HDF5 quicklook file for browsing a scan.
+
+    Each normalized column is stored at several resolutions as per-bin min/max
+    pairs under "level_<nbins>", skipping levels that would not be smaller than
+    the scan. A scan too short for any level is stored once, undecimated, under
+    "raw". Any RIXS data is stored as a pyramid of incident x emission maps from
+    make_rixs_maps under "rixs/level_<n>", coarsest last. Values are stored as
+    QUICKLOOK_DTYPE.
+
+    Parameters
+    ----------
+    folder : str
+        Export directory where the quicklook file will be saved.
+    run : Run
+        The run to export.
+    header_updates : dict
+        Dictionary of additional header fields to update or add.
+    columns : list, optional
+        Column names already loaded by exportToHDF5, to avoid reading the run again.
+    run_data : list, optional
+        Column data already loaded by exportToHDF5.
+    metadata : dict, optional
+        Header already loaded by exportToHDF5.
+    levels : tuple of int, optional
+        Number of bins at each level to consider.
+    manifest_path : str, optional
+        Export manifest to record the file in. Defaults to one in `folder`.
+    reads : dict, optional
+        Data already read by tiled_access.read_run with omit_array_keys=False, to
+        avoid reading the run again.
+
+    Returns
+    -------
+    bool
+        True if the file was written.
+    """
+    if columns is None or run_data is None or metadata is None:
+        if "primary" not in run:
+            print(
+                f"Quicklook Export does not support streams other than Primary, skipping {run.start['scan_id']}"
+            )
+            return False
+        if reads is None:
+            reads = read_run(run, omit_array_keys=False)
+        metadata = get_xdi_run_header(run, header_updates, reads=reads)
+        columns, run_data, metadata = get_xdi_normalized_data(
+            run, metadata, omit_array_keys=False, reads=reads
+        )
+    filename = make_filename(folder, metadata, "hdf5", suffix="quicklook")
+    print(f"Exporting Quicklook to {filename}")
+
+    # Build the file in memory so it can be checksummed as it is written out
+    buffer = io.BytesIO()
+    line_data = {
+        name: data
+        for name, data in zip(columns, run_data)
+        if name != "rixs" and np.ndim(data) == 1
+    }
+    npts = max((len(data) for data in line_data.values()), default=0)
+    with h5py.File(buffer, "w") as f:
+        quicklook_levels = get_quicklook_levels(npts, levels)
+        if not quicklook_levels and line_data:
+            g = f.create_group("raw")
+            g.attrs["nbins"] = npts
+            for name, data in line_data.items():
+                try:
+                    create_quicklook_dataset(g, name, data)
+                except (TypeError, ValueError):
+                    continue
+        for nbins in quicklook_levels:
+            g = f.create_group(f"level_{nbins}")
+            g.attrs["nbins"] = nbins
+            for name, data in line_data.items():
+                try:
+                    create_quicklook_dataset(g, name, minmax_decimate(data, nbins))
+                except (TypeError, ValueError):
+                    continue
+        rixs_maps = quicklook_rixs_maps(columns, run_data, metadata)
+        if rixs_maps:
+            g = f.create_group("rixs")
+            for level, rixs_map in enumerate(rixs_maps):
+                lg = g.create_group(f"level_{level}")
+                create_quicklook_dataset(lg, "counts", rixs_map["counts"])
+                lg.create_dataset(
+                    "incident_energies", data=rixs_map["incident_energies"]
+                )
+                lg.create_dataset(
+                    "emission_energies", data=rixs_map["emission_energies"]
+                )
+                lg.attrs["incident_width"] = rixs_map["incident_width"]
+                lg.attrs["emission_width"] = rixs_map["emission_width"]
+        for key, value in metadata.items():
+            f.attrs[key] = value
+    write_checksummed_bytes(
+        filename, buffer.getbuffer(), uid=run.start["uid"], manifest_path=manifest_path
+    )
+
+    return True
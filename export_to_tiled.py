@@ -1,4 +1,6 @@
+from tiled_access import read_run
 from export_to_xdi import get_xdi_normalized_data, get_xdi_run_header
+from rixs_tools import is_rixs_grid, make_rixs_maps
 import xarray as xr
 
 
@@ -19,12 +21,91 @@ def transform_header(metadata):
     return transformed
 
 
-def export_to_tiled(run, header_updates={}):
+def build_dataset(columns, run_data, chunks=None):
+    """
+    Build an xarray Dataset directly from normalized columns.
+
+    Arrays are wrapped as-is, without per-column alignment or merging. A "time"
+    column becomes the shared coordinate of the "time" dimension.
+
+    Parameters
+    ----------
+    columns : list
+        The column names, as returned by get_xdi_normalized_data.
+    run_data : list
+        The column data, in the same order as columns.
+    chunks : dict or int, optional
+        If given, back the dataset with dask arrays using these chunks.
+
+    Returns
+    -------
+    xr.Dataset
+    """
+    data_vars = {}
+    coords = {}
+    for name, data in zip(columns, run_data):
+        if name == "time":
+            coords["time"] = ("time", data)
+        elif name == "rixs":
+            if is_rixs_grid(data):
+                counts, mono_grid, energy_grid = data
+                # Keep the native (emission, time) layout instead of transposing
+                data_vars[name] = (("emission", "time"), counts)
+                coords["emission"] = ("emission", energy_grid[:, 0])
+            else:
+                data_vars[name] = (("time", "emission"), data)
+        else:
+            data_vars[name] = (("time",), data)
+
+    ds = xr.Dataset(data_vars, coords=coords)
+    if chunks is not None:
+        ds = ds.chunk(chunks)
+    return ds
+
+
+def add_rixs_maps(ds, rixs_maps):
+    """
+    Add regridded RIXS maps to a dataset as "rixs_map_<level>" variables, in place.
+
+    Each level has its own "incident_<level>" and "emission_<level>" coordinates.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+    rixs_maps : list of dict
+        Maps as returned by make_rixs_maps.
+    """
+    for level, rixs_map in enumerate(rixs_maps):
+        incident = f"incident_{level}"
+        emission = f"emission_{level}"
+        ds[f"rixs_map_{level}"] = xr.DataArray(
+            rixs_map["counts"],
+            coords={
+                incident: rixs_map["incident_energies"],
+                emission: rixs_map["emission_energies"],
+            },
+            dims=(incident, emission),
+            attrs={
+                "incident_width": rixs_map["incident_width"],
+                "emission_width": rixs_map["emission_width"],
+            },
+        )
+
+
+def export_to_tiled(run, header_updates={}, chunks=None, rixs_bin_widths=None):
     """
     Export a run to a tiled catalog.
 
     Parameters
     ----------
+    run : Run
+    header_updates : dict
+        Dictionary of additional header fields to update or add.
+    chunks : dict or int, optional
+        If given, return a dask-backed dataset using these chunks.
+    rixs_bin_widths : list of (float, float), optional
+        (incident, emission) bin widths of the RIXS maps, one pair per map.
+        Defaults to multiples of the native spacing from make_rixs_maps.
     """
 
     if "primary" not in run:
@@ -32,35 +113,18 @@ def export_to_tiled(run, header_updates={}):
             f"Tiled Export does not support streams other than Primary, skipping {run.start['scan_id']}"
         )
         return False
-    metadata = get_xdi_run_header(run, header_updates)
+    reads = read_run(run, omit_array_keys=False)
+    metadata = get_xdi_run_header(run, header_updates, reads=reads)
     print("Got XDI Metadata")
 
     columns, run_data, metadata = get_xdi_normalized_data(
-        run, metadata, omit_array_keys=False
+        run, metadata, omit_array_keys=False, reads=reads
     )
 
-    da_dict = {}
-    for name, data in zip(columns, run_data):
-        if name == "rixs":
-            if len(data) == 3:
-                counts, mono_grid, energy_grid = data
-                rixs = xr.DataArray(
-                    counts.T,
-                    coords={"emission": energy_grid[:, 0]},
-                    dims=("time", "emission"),
-                    name=name,
-                )
-            else:
-                rixs = xr.DataArray(data, dims=("time", "emission"), name=name)
-            da_dict[name] = rixs
-        else:
-            da_dict[name] = xr.DataArray(data, dims=("time",), name=name)
-
-    if "time" in da_dict:
-        time_coord = da_dict.pop("time")
-        for name, da in da_dict.items():
-            da.coords["time"] = time_coord
-    da = xr.merge(da_dict.values())
+    da = build_dataset(columns, run_data, chunks=chunks)
+    add_rixs_maps(
+        da, make_rixs_maps(columns, run_data, metadata, bin_widths=rixs_bin_widths)
+    )
     metadata = transform_header(metadata)
     data_session = run.start.get("data_session", None)
     if data_session is not None:
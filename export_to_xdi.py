@@ -1,25 +1,20 @@
 import numpy as np
 from os.path import join
 from export_tools import (
-    get_with_fallbacks,
+    get_baseline_values,
+    get_config_values,
     get_run_data,
     add_comment_to_lines,
+    checksummed_open,
+    compute_column_stats,
     sanitize_filename,
+    write_columns,
 )
 from datetime import datetime
+from tiled_access import read_run
 
 
-def get_config(config, keys, default=None):
-    try:
-        item = get_with_fallbacks(config, keys)
-        if item is None:
-            return default
-        return item.read()
-    except Exception:
-        return default
-
-
-def get_xdi_run_header(run, header_updates={}):
+def get_xdi_run_header(run, header_updates={}, reads=None):
     """
     Generate an XDI header dictionary from a run.
 
@@ -28,20 +23,26 @@ def get_xdi_run_header(run, header_updates={}):
     run : Run
     header_updates : dict
         Dictionary of additional header fields to update or add.
+    reads : dict, optional
+        Data already read by tiled_access.read_run, to avoid reading it again.
 
     Returns
     -------
     metadata : dict
         The XDI header dictionary.
     """
-    baseline = run.baseline.data.read()
+    if reads is not None:
+        baseline = reads["baseline"]
+        config = reads["config"]
+    else:
+        baseline = run.baseline.data.read()
+        config = get_config_values(run.baseline)
+    baseline_values = get_baseline_values(baseline)
     proposal = run.start.get("proposal", {})
     metadata = {}
     metadata["Facility.name"] = "NSLS-II"
     metadata["Facility.xray_source"] = "EPU60 Undulator"
-    metadata["Facility.current"] = "{:.2f} mA".format(
-        float(get_with_fallbacks(baseline, "NSLS-II Ring Current", default=[400])[0])
-    )
+    metadata["Facility.current"] = "{:.2f} mA".format(baseline_values["ring_current"])
     metadata["Facility.cycle"] = run.start.get("cycle", "")
     metadata["Facility.GUP"] = proposal.get("proposal_id", "")
     metadata["Facility.SAF"] = proposal.get("saf", "")
@@ -49,9 +50,10 @@ def get_xdi_run_header(run, header_updates={}):
     metadata["Beamline.name"] = "7-ID-1"
     metadata["Beamline.chamber"] = "NEXAFS"
 
-    metadata["Mono.stripe"] = str(
-        get_config(run.baseline.config, ["en", "en_monoen_gratingx_setpoint"], [""])[0]
-    )
+    mono_stripe = config.get("mono_stripe", "")
+    if isinstance(mono_stripe, (list, tuple)):
+        mono_stripe = mono_stripe[0] if len(mono_stripe) > 0 else ""
+    metadata["Mono.stripe"] = str(mono_stripe)
 
     metadata["Sample.name"] = run.start.get("sample_name", "")
     metadata["Sample.id"] = run.start.get("sample_id", "")
@@ -92,49 +94,117 @@ def get_xdi_run_header(run, header_updates={}):
         elif element.lower() in ["ce"]:
             metadata["Element.edge"] = "M"
 
-    metadata["Motors.exslit"] = float(
-        get_with_fallbacks(
-            baseline, "eslit", "Exit Slit of Mono Vertical Gap", default=[0]
-        )[0]
-    )
-    metadata["Motors.manipx"] = float(
-        get_with_fallbacks(baseline, "manip_x", "Manipulator_x", default=[0])[0]
-    )
-    metadata["Motors.manipy"] = float(
-        get_with_fallbacks(baseline, "manip_y", "Manipulator_y", default=[0])[0]
-    )
-    metadata["Motors.manipz"] = float(
-        get_with_fallbacks(baseline, "manip_z", "Manipulator_z", default=[0])[0]
-    )
-    metadata["Motors.manipr"] = float(
-        get_with_fallbacks(baseline, "manip_r", "Manipulator_r", default=[0])[0]
-    )
-    metadata["Motors.tesz"] = float(
-        get_with_fallbacks(baseline, "tesz", default=[0])[0]
-    )
+    for name in [
+        "exslit",
+        "manipx",
+        "manipy",
+        "manipz",
+        "manipr",
+        "samplex",
+        "sampley",
+        "samplez",
+        "sampler",
+        "tesz",
+    ]:
+        metadata[f"Motors.{name}"] = baseline_values[name]
     metadata.update(header_updates)
     return metadata
 
 
-def normalize_detector(search, replace, columns, header=None, description=None):
-    if search in columns:
-        columns[columns.index(search)] = replace
-        if header is not None:
-            if description is None:
-                description = search
-            header[f"Detector.{replace}"] = description
-
-
-def exclude_column(search, columns, data):
-    if search in columns:
-        idx = columns.index(search)
-        columns.pop(idx)
-        data.pop(idx)
+# Source key -> canonical name and "Detector." header description, in header order.
+# "alternate" is a (name, description) pair used instead when the canonical name
+# is already taken by another column. "exclude" drops the column entirely.
+DETECTOR_SCHEMA = {
+    "nexafs_i0up": {
+        "name": "i0",
+        "description": "Beam intensity normalization via drain current from NEXAFS upstream Au mesh",
+    },
+    "nexafs_i1": {
+        "name": "itrans",
+        "description": "Transmission intensity via downstream diode",
+    },
+    "nexafs_sc": {
+        "name": "tey",  # codespell:ignore tey
+        "description": "Total electron yield via drain current from NEXAFS sample bar",
+    },
+    "nexafs_pey": {
+        "name": "pey",
+        "description": "Partial electron yield via NEXAFS Channeltron",
+    },
+    "nexafs_ref": {
+        "name": "iref",
+        "description": "Energy reference via drain current from upstream multimesh reference samples",
+    },
+    "tes_mca_counts": {
+        "name": "tfy",
+        "description": "Total fluorescence yield via counts from TES detector",
+    },
+    "tes_mca_pfy": {
+        "name": "pfy",
+        "description": "Partial fluorescence yield via counts from TES detector",
+    },
+    "tes_mca_spectrum": {
+        "name": "rixs",
+        "description": "RIXS spectrum via TES detector",
+    },
+    "m4cd": {
+        "name": "i0_m4cd",
+        "description": "Drain current from M4 mirror, sometimes useful as a secondary i0",
+    },
+    "en_energy_setpoint": {"name": "energy"},
+    "seconds": {"name": "measurement_time"},
+    "en_energy": {
+        "name": "energy",
+        "alternate": ("energy_readback", "Monochromator energy encoder readback"),
+    },
+    "ucal_sc": {"exclude": True},
+}
+
+
+def compile_detector_schema(schema):
+    """
+    Compile a detector schema into lookup tables for apply_detector_schema.
 
+    Parameters
+    ----------
+    schema : dict
+        Mapping of source key to a dict with optional "name", "description",
+        "alternate", and "exclude" entries, in header order.
 
-def reorder_columns(columns, data, key, index):
+    Returns
+    -------
+    dict
+        Lookup tables keyed by source key: "rename", "description", "alternate",
+        "priority", plus the set of "exclude" keys.
     """
-    Reorder columns and data to move a key to a specific index.
+    compiled = {
+        "rename": {},
+        "description": {},
+        "alternate": {},
+        "priority": {},
+        "exclude": set(),
+    }
+    for priority, (key, entry) in enumerate(schema.items()):
+        compiled["priority"][key] = priority
+        if entry.get("exclude", False):
+            compiled["exclude"].add(key)
+            continue
+        compiled["rename"][key] = entry["name"]
+        if entry.get("description") is not None:
+            compiled["description"][key] = entry["description"]
+        if entry.get("alternate") is not None:
+            compiled["alternate"][key] = entry["alternate"]
+    return compiled
+
+
+COMPILED_DETECTOR_SCHEMA = compile_detector_schema(DETECTOR_SCHEMA)
+
+
+def apply_detector_schema(
+    columns, data, header=None, first_column=None, schema=COMPILED_DETECTOR_SCHEMA
+):
+    """
+    Rename, exclude, and reorder columns according to a compiled detector schema.
 
     Parameters
     ----------
@@ -142,18 +212,50 @@ def reorder_columns(columns, data, key, index):
         The list of column names.
     data : list
         The list of data arrays.
-    key : str
-        The key to move.
-    index : int
-        The index to move the key to.
+    header : dict, optional
+        If given, "Detector.<name>" descriptions are added for renamed columns.
+    first_column : str, optional
+        Canonical name of a column to move to the front, typically the scan motor.
+    schema : dict, optional
+        A schema compiled by compile_detector_schema.
+
+    Returns
+    -------
+    columns : list
+        The new column names.
+    data : list
+        The data arrays, in the same order as columns.
     """
-    if key in columns:
-        key_idx = columns.index(key)
-        columns.pop(key_idx)
-        column_data = data.pop(key_idx)
-        columns.insert(index, key)
-        data.insert(index, column_data)
-    return columns, data
+    rename = schema["rename"]
+    alternate = schema["alternate"]
+    exclude = schema["exclude"]
+    taken = {rename.get(c, c) for c in columns if c not in alternate}
+
+    new_columns = []
+    new_data = []
+    described = []
+    moved_first = False
+    for column, column_data in zip(columns, data):
+        if column in exclude:
+            continue
+        name = rename.get(column, column)
+        description = schema["description"].get(column)
+        if column in alternate and name in taken:
+            name, description = alternate[column]
+        if description is not None:
+            described.append((schema["priority"][column], name, description))
+        if name == first_column and not moved_first:
+            moved_first = True
+            new_columns.insert(0, name)
+            new_data.insert(0, column_data)
+        else:
+            new_columns.append(name)
+            new_data.append(column_data)
+
+    if header is not None:
+        for _, name, description in sorted(described):
+            header[f"Detector.{name}"] = description
+    return new_columns, new_data
 
 
 def make_filename(folder, metadata, ext="xdi", suffix=None):
@@ -177,7 +279,7 @@ def make_filename(folder, metadata, ext="xdi", suffix=None):
     return filename
 
 
-def get_xdi_normalized_data(run, metadata, omit_array_keys=True):
+def get_xdi_normalized_data(run, metadata, omit_array_keys=True, reads=None):
     """
     Get run data, and rename detectors to standard names for XDI export. Modify metadata in place.
 
@@ -187,6 +289,10 @@ def get_xdi_normalized_data(run, metadata, omit_array_keys=True):
         The run to normalize.
     metadata : dict
         The metadata to modify.
+    omit_array_keys : bool
+        If True, leave out array data such as the RIXS spectrum.
+    reads : dict, optional
+        Data already read by tiled_access.read_run, to avoid reading it again.
 
     Returns
     -------
@@ -201,6 +307,8 @@ def get_xdi_normalized_data(run, metadata, omit_array_keys=True):
         run,
         omit=["tes_scan_point_start", "tes_scan_point_end"],
         omit_array_keys=omit_array_keys,
+        usekeys=None if reads is None else reads["primary_keys"],
+        data=None if reads is None else reads["primary"],
     )
     print("Got XDI Data")
 
@@ -224,84 +332,11 @@ def get_xdi_normalized_data(run, metadata, omit_array_keys=True):
     if "tes_mca_spectrum" in columns:
         metadata["rois.rixs"] = metadata.pop("rois.tes_mca_spectrum", "")
 
-    # Rename energy columns if present
-    normalize_detector(
-        "nexafs_i0up",
-        "i0",
-        columns,
-        metadata,
-        "Beam intensity normalization via drain current from NEXAFS upstream Au mesh",
-    )
-    normalize_detector(
-        "nexafs_i1",
-        "itrans",
-        columns,
-        metadata,
-        "Transmission intensity via downstream diode",
-    )
-    normalize_detector(
-        "nexafs_sc",
-        "tey",  # codespell:ignore tey
-        columns,
-        metadata,
-        "Total electron yield via drain current from NEXAFS sample bar",
-    )
-    normalize_detector(
-        "nexafs_pey",
-        "pey",
-        columns,
-        metadata,
-        "Partial electron yield via NEXAFS Channeltron",
-    )
-    normalize_detector(
-        "nexafs_ref",
-        "iref",
-        columns,
-        metadata,
-        "Energy reference via drain current from upstream multimesh reference samples",
-    )
-    normalize_detector(
-        "tes_mca_counts",
-        "tfy",
-        columns,
-        metadata,
-        "Total fluorescence yield via counts from TES detector",
-    )
-
-    normalize_detector(
-        "tes_mca_pfy",
-        "pfy",
-        columns,
-        metadata,
-        "Partial fluorescence yield via counts from TES detector",
-    )
-    normalize_detector(
-        "tes_mca_spectrum", "rixs", columns, metadata, "RIXS spectrum via TES detector"
-    )
-    normalize_detector(
-        "m4cd",
-        "i0_m4cd",
-        columns,
-        metadata,
-        "Drain current from M4 mirror, sometimes useful as a secondary i0",
-    )
-    normalize_detector("en_energy_setpoint", "energy", columns)
-    normalize_detector("seconds", "measurement_time", columns)
     if metadata.get("Scan.motors", "") == "en_energy":
         metadata["Scan.motors"] = "energy"
-    if "energy" in columns:
-        normalize_detector(
-            "en_energy",
-            "energy_readback",
-            columns,
-            metadata,
-            "Monochromator energy encoder readback",
-        )
-    else:
-        normalize_detector("en_energy", "energy", columns)
-    exclude_column("ucal_sc", columns, run_data)
-    columns, run_data = reorder_columns(
-        columns, run_data, metadata.get("Scan.motors", "time"), 0
+
+    columns, run_data = apply_detector_schema(
+        columns, run_data, metadata, metadata.get("Scan.motors", "time")
     )
     return columns, run_data, metadata
 
@@ -310,6 +345,9 @@ def exportToXDI(
     folder,
     run,
     headerUpdates={},
+    compress=False,
+    manifest_path=None,
+    reads=None,
 ):
     """
     Export data to the XAS-Data-Interchange (XDI) ASCII format.
@@ -322,27 +360,40 @@ def exportToXDI(
         The run to export.
     headerUpdates : dict
         Dictionary of additional header fields to update or add.
+    compress : bool
+        If True, write a gzip-compressed ".xdi.gz" file.
+    manifest_path : str, optional
+        Export manifest to record the file in. Defaults to one in `folder`.
+    reads : dict, optional
+        Data already read by tiled_access.read_run, to avoid reading the run again.
+        Array keys in it are left out of the file.
     verbose : bool
         If True, prints export status messages.
 
     Returns
     -------
-    None
+    columns : list
+        The exported column names.
+    run_data : list
+        The exported column data.
+    metadata : dict
+        The exported header.
     """
     if "primary" not in run:
         print(
             f"XDI Export does not support streams other than Primary, skipping {run.start['scan_id']}"
         )
         return False
-    metadata = get_xdi_run_header(run, headerUpdates)
+    if reads is None:
+        reads = read_run(run)
+    metadata = get_xdi_run_header(run, headerUpdates, reads=reads)
     print("Got XDI Metadata")
-    filename = make_filename(folder, metadata)
+    filename = make_filename(folder, metadata, "xdi.gz" if compress else "xdi")
 
-    columns, run_data, metadata = get_xdi_normalized_data(run, metadata)
+    columns, run_data, metadata = get_xdi_normalized_data(run, metadata, reads=reads)
 
     fmtStr = generate_format_string(run_data)
 
-    data = np.vstack(run_data).T
     colStr = " ".join(columns)
 
     header_lines = ["# XDI/1.0 SST-1-NEXAFS/1.0"]
@@ -354,13 +405,20 @@ def exportToXDI(
     header_lines.append("# " + colStr)
     header_string = "\n".join(header_lines)
     print(f"Exporting XDI to {filename}")
-    with open(filename, "w") as f:
+    with checksummed_open(
+        filename,
+        "w",
+        compress=compress,
+        uid=run.start["uid"],
+        manifest_path=manifest_path,
+    ) as f:
         f.write(header_string)
         f.write("\n")
-        np.savetxt(f, data, fmt=fmtStr, delimiter=" ")
+        write_columns(f, run_data, fmtStr)
+    return columns, run_data, metadata
 
 
-def generate_format_string(data):
+def generate_format_string(data, stats=None):
     """
     Generate a format string for numpy.savetxt based on data type and average value.
 
@@ -368,31 +426,36 @@ def generate_format_string(data):
     ----------
     data : np.ndarray
         The input data array.
+    stats : dict, optional
+        Column statistics from compute_column_stats, if already computed.
 
     Returns
     -------
     str
         A format string for numpy.savetxt.
     """
+    if stats is None:
+        stats = compute_column_stats(data)
+
+    # Number of digits in the integer part of each column's largest magnitude
+    with np.errstate(divide="ignore", invalid="ignore"):
+        digits = np.where(
+            stats["abs_max"] >= 1, np.floor(np.log10(stats["abs_max"])) + 1, 1
+        )
+
     formats = []
-    for column_data in data:
-        try:
-            if not np.any(np.isfinite(column_data)):
-                formats.append("%11.4e")
-            elif np.issubdtype(column_data.dtype, np.integer):
-                width = len(str(np.nanmax(np.abs(column_data)))) + 1
-                formats.append(f"%{width}d")
-            else:
-                avg_value = np.nanmean(column_data)
-                max_value = np.nanmax(np.abs(column_data))
-                if np.abs(avg_value) < 1:
-                    formats.append("%11.4e")
-                else:
-                    width = (
-                        len(str(int(max_value))) + 5
-                    )  # Add 5 for decimal point, 3 decimals, and sign
-                    formats.append(f"%{width}.3f")
-        except Exception:
+    for i in range(len(data)):
+        if not stats["numeric"][i] or not stats["any_finite"][i]:
+            formats.append("%11.4e")
+        elif not np.isfinite(stats["abs_max"][i]):
+            formats.append("%11.4e")
+        elif stats["integer"][i]:
+            width = int(digits[i]) + 1
+            formats.append(f"%{width}d")
+        elif np.abs(stats["mean"][i]) < 1:
             formats.append("%11.4e")
+        else:
+            width = int(digits[i]) + 5  # Add 5 for decimal point, 3 decimals, and sign
+            formats.append(f"%{width}.3f")
 
     return " ".join(formats)
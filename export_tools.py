@@ -1,16 +1,39 @@
 import datetime
+import gzip
+import hashlib
+import io
+import json
 import numpy as np
-from os.path import join
+import os
+import tempfile
+import threading
+import warnings
+from contextlib import contextmanager
+from os.path import basename, dirname, join
 from autoprocess.statelessAnalysis import get_tes_data, get_tes_rois
 from autoprocess.utils import run_is_processed
 from prefect.blocks.system import Secret
-from tiled.client import from_profile
+from tiled.client import from_profile, from_uri
 import re
 
+# If set, runs are read from this Tiled server instead of the nsls2 profile, e.g. a
+# local archive served by replay_shift.py, authenticating with TILED_API_KEY
+TILED_URI_ENV = "UCAL_TILED_URI"
+# If set, exports are written under this directory instead of the proposals root
+PROPOSALS_ROOT_ENV = "UCAL_PROPOSALS_ROOT"
+PROPOSALS_ROOT = "/nsls2/data/sst/proposals"
+# If set, TES calibration and processing info is saved under this directory instead
+PROCESS_INFO_PATH_ENV = "UCAL_PROCESS_INFO_PATH"
+PROCESS_INFO_PATH = "/nsls2/data/sst/legacy/ucal/process_info"
 
-def initialize_tiled_client(beamline_acronym):
+
+def initialize_tiled_client(beamline_acronym, node="raw"):
+    uri = os.environ.get(TILED_URI_ENV)
+    if uri:
+        api_key = os.environ.get("TILED_API_KEY")
+        return from_uri(uri, api_key=api_key)[beamline_acronym][node]
     api_key = Secret.load(f"tiled-{beamline_acronym}-api-key", _sync=True).get()
-    return from_profile("nsls2", api_key=api_key)[beamline_acronym]["raw"]
+    return from_profile("nsls2", api_key=api_key)[beamline_acronym][node]
 
 
 def get_proposal_path(run):
@@ -21,104 +44,149 @@ def get_proposal_path(run):
     cycle = run.start.get("cycle", None)
     if proposal is None or cycle is None:
         raise ValueError("Proposal Metadata not Loaded")
+    proposals_root = os.environ.get(PROPOSALS_ROOT_ENV, PROPOSALS_ROOT)
     if is_commissioning:
-        proposal_path = f"/nsls2/data/sst/proposals/commissioning/pass-{proposal}/"
+        proposal_path = f"{proposals_root}/commissioning/pass-{proposal}/"
     else:
-        proposal_path = f"/nsls2/data/sst/proposals/{cycle}/pass-{proposal}/"
+        proposal_path = f"{proposals_root}/{cycle}/pass-{proposal}/"
     return proposal_path
 
 
-def get_with_fallbacks(thing, *possible_names, default=None):
-    for name in possible_names:
-        if isinstance(name, (list, tuple)):
-            for subname in name:
-                if subname in thing:
-                    thing = thing[subname]
-                    found_thing = True
-                else:
-                    found_thing = False
-            if found_thing:
-                return thing
-        elif name in thing:
-            return thing[name]
-    return default
-
-
-def get_header_and_data(run):
-    cols, run_data, rois = get_run_data(run)
-    header = get_run_header(run)
-    header["channelinfo"]["cols"] = cols
-    data = np.vstack(run_data).T
-    return header, data
-
-
-def get_run_header(run):
-    metadata = {}
-    scaninfo = {}
-    scaninfo["scan"] = run.start["scan_id"]
-    scaninfo["date"] = datetime.datetime.fromtimestamp(run.start["time"]).isoformat()
-    scaninfo["sample"] = run.start.get("sample_name", "")
-    scaninfo["loadid"] = run.start.get("sample_id", "")
-
-    scaninfo["command"] = get_with_fallbacks(
-        run.start, "command", "plan_name", default=None
-    )
-    scaninfo["motor"] = run.start.get("motors", ["time"])[0]
-    scankeys = [
-        "time",
-        "data_session",
-        "cycle",
-        "start_datetime",
-        "repeat",
+# Canonical baseline names, the keys they may be recorded under (in order of
+# preference), and the value used when none is present
+BASELINE_ALIASES = {
+    "ring_current": (("NSLS-II Ring Current",), 400),
+    "exslit": (("eslit", "Exit Slit of Mono Vertical Gap"), 0),
+    "manipx": (("manip_x", "Manipulator_x"), 0),
+    "manipy": (("manip_y", "Manipulator_y"), 0),
+    "manipz": (("manip_z", "Manipulator_z"), 0),
+    "manipr": (("manip_r", "Manipulator_r"), 0),
+    "samplex": (("manip_sx", "Manipulator_sx"), 0),
+    "sampley": (("manip_sy", "Manipulator_sy"), 0),
+    "samplez": (("manip_sz", "Manipulator_sz"), 0),
+    "sampler": (("manip_sr", "Manipulator_sr"), 0),
+    "tesz": (("tesz",), 0),
+}
+
+# Canonical configuration names and the (device, key) pairs they may be recorded
+# under in a stream's descriptor configuration, in order of preference
+BASELINE_CONFIG_ALIASES = {
+    "mono_stripe": (("en", "en_monoen_gratingx_setpoint"),),
+}
+PRIMARY_CONFIG_ALIASES = {
+    "exposure": (
+        ("nexafs_i0up", "nexafs_i0up_exposure_time"),
+        ("nexafs_i1", "nexafs_i0up_exposure_time"),
+        ("nexafs_sc", "ucal_sc_exposure_time"),
+    ),
+}
+
+
+def resolve_aliases(aliases, available):
+    """
+    Map canonical names to the key each one is actually recorded under.
+
+    Parameters
+    ----------
+    aliases : dict
+        Mapping of canonical name to a tuple of candidate keys, in order of
+        preference.
+    available : iterable
+        The keys present in this run.
+
+    Returns
+    -------
+    dict
+        Mapping of canonical name to the first candidate key that is present.
+        Names with no candidate present are left out.
+    """
+    available = set(available)
+    index = {}
+    for name, candidates in aliases.items():
+        for candidate in candidates:
+            if candidate in available:
+                index[name] = candidate
+                break
+    return index
+
+
+def get_baseline_values(baseline):
+    """
+    Get the first value of every BASELINE_ALIASES entry from baseline data.
+
+    Parameters
+    ----------
+    baseline : xr.Dataset
+        The baseline stream data.
+
+    Returns
+    -------
+    dict
+        Mapping of canonical name to a float, or its default if not recorded.
+    """
+    aliases = {name: keys for name, (keys, default) in BASELINE_ALIASES.items()}
+    index = resolve_aliases(aliases, baseline.keys())
+    values = {}
+    for name, (keys, default) in BASELINE_ALIASES.items():
+        if name in index:
+            values[name] = float(baseline[index[name]][0])
+        else:
+            values[name] = float(default)
+    return values
+
+
+def get_config_values(stream, aliases=BASELINE_CONFIG_ALIASES):
+    """
+    Get configuration values from a stream's first descriptor.
+
+    The values come from the descriptor's "configuration" metadata, so this is
+    one metadata request for all of them, with no reads of configuration data.
+
+    Parameters
+    ----------
+    stream : BlueskyEventStream
+        The stream, e.g. run.baseline or run.primary.
+    aliases : dict, optional
+        Mapping of canonical name to (device, key) candidates.
+
+    Returns
+    -------
+    dict
+        Mapping of canonical name to its value. Names that are not recorded are
+        left out.
+    """
+    try:
+        configuration = stream.descriptors[0]["configuration"]
+    except Exception:
+        return {}
+    available = [
+        (device, key)
+        for device, device_config in configuration.items()
+        for key in device_config.get("data", {})
     ]
-    for k in scankeys:
-        if k in run.start:
-            scaninfo[k] = run.start[k]
-    if "ref_args" in run.start:
-        scaninfo["ref_edge"] = run.start["ref_args"][
-            "i0up_multimesh_sample_sample_name"
-        ]["value"]
-        scaninfo["ref_id"] = run.start["ref_args"]["i0up_multimesh_sample_sample_id"][
-            "value"
-        ]
-    scaninfo["uid"] = run.start["uid"]
-    motors = {}
-    baseline = run.baseline.data.read()
-    motors["exslit"] = get_with_fallbacks(
-        baseline, "eslit", "Exit Slit of Mono Vertical Gap"
-    )[0].item()
-    motors["manipx"] = float(
-        get_with_fallbacks(baseline, "manip_x", "Manipulator_x", default=[0])[0]
-    )
-    motors["manipy"] = float(
-        get_with_fallbacks(baseline, "manip_y", "Manipulator_y", default=[0])[0]
-    )
-    motors["manipz"] = float(
-        get_with_fallbacks(baseline, "manip_z", "Manipulator_z", default=[0])[0]
-    )
-    motors["manipr"] = float(
-        get_with_fallbacks(baseline, "manip_r", "Manipulator_r", default=[0])[0]
-    )
-    motors["samplex"] = float(
-        get_with_fallbacks(baseline, "manip_sx", "Manipulator_sx", default=[0])[0]
-    )
-    motors["sampley"] = float(
-        get_with_fallbacks(baseline, "manip_sy", "Manipulator_sy", default=[0])[0]
-    )
-    motors["samplez"] = float(
-        get_with_fallbacks(baseline, "manip_sz", "Manipulator_sz", default=[0])[0]
-    )
-    motors["sampler"] = float(
-        get_with_fallbacks(baseline, "manip_sr", "Manipulator_sr", default=[0])[0]
-    )
-    motors["tesz"] = float(get_with_fallbacks(baseline, "tesz", default=[0])[0])
-    metadata["scaninfo"] = scaninfo
-    metadata["motors"] = motors
-    metadata["channelinfo"] = {}
-    return metadata
+    index = resolve_aliases(aliases, available)
+    return {
+        name: configuration[device]["data"][key]
+        for name, (device, key) in index.items()
+    }
+
+
+KNOWN_ARRAY_KEYS = ["tes_mca_spectrum", "spectrum"]
+
+
+def get_primary_keys(run, omit_array_keys=True):
+    """
+    Get the primary stream keys to read, leaving out known array keys if requested.
+    """
+    usekeys = []
+    for key in run.primary.data.keys():
+        if key in KNOWN_ARRAY_KEYS and omit_array_keys:
+            continue
+        usekeys.append(key)
+    return usekeys
 
 
-def get_run_data(run, omit=[], omit_array_keys=True):
+def get_run_data(run, omit=[], omit_array_keys=True, usekeys=None, data=None):
     first_keys = [
         "en_energy_setpoint",
         "en_energy",
@@ -132,28 +200,20 @@ def get_run_data(run, omit=[], omit_array_keys=True):
         "time",
         "seconds",
     ]
-    config = run.primary.descriptors[0]["configuration"]
-    exposure = get_with_fallbacks(
-        config,
-        ["nexafs_i0up", "data", "nexafs_i0up_exposure_time"],
-        ["nexafs_i1", "data", "nexafs_i0up_exposure_time"],
-        ["nexafs_sc", "data", "ucal_sc_exposure_time"],
-    )
+    exposure = get_config_values(run.primary, PRIMARY_CONFIG_ALIASES).get("exposure")
     if exposure is None:
         exposure = 0
     exposure = float(exposure)
     columns = []
     datadict = {}
-    known_array_keys = ["tes_mca_spectrum", "spectrum"]
-
-    keys = run.primary.data.keys()
-    usekeys = []
 
-    for key in keys:
-        if key in known_array_keys and omit_array_keys:
-            continue
-        usekeys.append(key)
-    data = run.primary.data.read(usekeys)
+    # usekeys and data may already have been read, e.g. by tiled_access.read_run
+    if usekeys is None:
+        usekeys = get_primary_keys(run, omit_array_keys)
+    usekeys = list(usekeys)
+    usekey_set = set(usekeys)
+    if data is None:
+        data = run.primary.data.read(usekeys)
     # Add a try-except here after testing
     save_directory = join(get_proposal_path(run), "ucal_processing")
 
@@ -166,8 +226,9 @@ def get_run_data(run, omit=[], omit_array_keys=True):
         rois = get_tes_rois(run, omit_array_keys=omit_array_keys)
         tes_data = {}
     for key in rois:
-        if key not in usekeys and key in tes_data:
+        if key not in usekey_set and key in tes_data:
             usekeys.append(key)
+            usekey_set.add(key)
     for key in usekeys:
         if key in tes_data:
             if key == "tes_mca_spectrum":
@@ -187,21 +248,127 @@ def get_run_data(run, omit=[], omit_array_keys=True):
                     datadict[key] = data[key].data
             except Exception:
                 continue
-    if "seconds" not in datadict:
-        datadict["seconds"] = np.zeros_like(datadict[key]) + exposure
+    # seconds is one value per point, so copy the last 1-D column, not e.g. a
+    # 2-D spectrum or a RIXS grid
+    like = next(
+        (v for v in reversed(datadict.values()) if getattr(v, "ndim", None) == 1), None
+    )
+    if "seconds" not in datadict and like is not None:
+        datadict["seconds"] = np.zeros_like(like) + exposure
+    omit = set(omit)
+    edge_keys = set(first_keys) | set(last_keys)
     for k in first_keys:
-        if k in datadict.keys() and k not in omit:
+        if k in datadict and k not in omit:
             columns.append(k)
-    for k in datadict.keys():
-        if k not in columns and k not in omit and k not in last_keys:
+    for k in datadict:
+        if k not in edge_keys and k not in omit:
             columns.append(k)
     for k in last_keys:
-        if k in datadict.keys() and k not in omit:
+        if k in datadict and k not in omit:
             columns.append(k)
     data = [datadict[k] for k in columns]
     return columns, data, rois
 
 
+def compute_column_stats(data):
+    """
+    Compute summary statistics for every column of a run at once.
+
+    Numeric 1-D columns of equal length and kind are stacked into a single block,
+    and each statistic is one reduction along the point axis of that block,
+    rather than several passes per column.
+
+    Parameters
+    ----------
+    data : list of np.ndarray
+        The column data, as returned by get_run_data.
+
+    Returns
+    -------
+    dict
+        Arrays with one entry per column: "numeric" and "integer" (bool),
+        "any_finite" (bool), and "min", "max", "abs_max", "mean" (float, NaN for
+        columns that are not numeric 1-D arrays). NaNs are ignored, as with
+        np.nanmax and np.nanmean.
+    """
+    ncols = len(data)
+    stats = {
+        "numeric": np.zeros(ncols, dtype=bool),
+        "integer": np.zeros(ncols, dtype=bool),
+        "any_finite": np.zeros(ncols, dtype=bool),
+        "min": np.full(ncols, np.nan),
+        "max": np.full(ncols, np.nan),
+        "abs_max": np.full(ncols, np.nan),
+        "mean": np.full(ncols, np.nan),
+    }
+    groups = {}
+    for i, column in enumerate(data):
+        if not isinstance(column, np.ndarray) or column.ndim != 1 or len(column) == 0:
+            continue
+        if column.dtype.kind not in "biuf":
+            continue
+        is_integer = column.dtype.kind in "iu"
+        groups.setdefault((is_integer, len(column)), []).append(i)
+
+    for (is_integer, npts), idx in groups.items():
+        block = np.vstack([data[i] for i in idx])
+        if is_integer:
+            col_min = block.min(axis=1).astype(float)
+            col_max = block.max(axis=1).astype(float)
+            col_mean = block.mean(axis=1)
+            any_finite = np.ones(len(idx), dtype=bool)
+        else:
+            block = block.astype(float, copy=False)
+            any_finite = np.isfinite(block).any(axis=1)
+            with warnings.catch_warnings():
+                # All-NaN columns are flagged by any_finite instead
+                warnings.simplefilter("ignore", RuntimeWarning)
+                col_min = np.nanmin(block, axis=1)
+                col_max = np.nanmax(block, axis=1)
+                col_mean = np.nanmean(block, axis=1)
+        stats["numeric"][idx] = True
+        stats["integer"][idx] = is_integer
+        stats["any_finite"][idx] = any_finite
+        stats["min"][idx] = col_min
+        stats["max"][idx] = col_max
+        stats["abs_max"][idx] = np.maximum(np.abs(col_min), np.abs(col_max))
+        stats["mean"][idx] = col_mean
+    return stats
+
+
+def write_columns(f, columns_data, fmt, delimiter=" ", block_rows=4096):
+    """
+    Write column arrays as delimited text rows, like numpy.savetxt.
+
+    The columns are never stacked into one full-size array. Each block of rows is
+    stacked on its own and formatted with a single string operation, rather than
+    one per row.
+
+    Parameters
+    ----------
+    f : file
+        An open text file.
+    columns_data : list of np.ndarray
+        1-D arrays of equal length, one per column.
+    fmt : str
+        A format for every row, or a single format repeated for each column.
+    delimiter : str, optional
+        Separator used when fmt is a single format.
+    block_rows : int, optional
+        Number of rows formatted at a time.
+    """
+    ncols = len(columns_data)
+    if ncols == 0:
+        return
+    if fmt.count("%") == 1:
+        fmt = delimiter.join([fmt] * ncols)
+    row_fmt = fmt + "\n"
+    npts = len(columns_data[0])
+    for start in range(0, npts, block_rows):
+        block = np.stack([c[start : start + block_rows] for c in columns_data], axis=1)
+        f.write((row_fmt * block.shape[0]) % tuple(block.ravel().tolist()))
+
+
 def add_comment_to_lines(multiline_string, comment_char="#"):
     """
     Adds a comment character to the beginning of each line in a multiline string.
@@ -248,3 +415,423 @@ def sanitize_filename(filename):
     # Replace whitespace and multiple underscores with single underscore
     filename = re.sub(r"[_\s]+", "_", filename)
     return filename
+
+
+def _read_umask():
+    # os.umask can only be read by setting it, which affects every thread, so
+    # read it once at import, before any export threads start
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# The process umask, applied to temp files, which mkstemp creates as 0o600
+UMASK = _read_umask()
+
+
+def fsync_directory(path):
+    """
+    Flush a directory's entries to disk, so that a rename into it survives a crash.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_write_path(filename):
+    """
+    Stage a write to a temporary file next to `filename`, then move it into place.
+
+    The temporary file lives in the same directory as `filename`, so the final
+    rename is atomic. Readers see either the old file or the complete new file,
+    never a truncated one. The file and then its directory are fsynced, so the
+    rename is also durable. If the body raises, the temporary file is removed
+    and `filename` is left untouched.
+
+    Parameters
+    ----------
+    filename : str
+        The final path of the file being written.
+
+    Yields
+    ------
+    str
+        The temporary path to write to.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f".{basename(filename)}.", suffix=".tmp", dir=dirname(filename) or "."
+    )
+    os.close(fd)
+    try:
+        yield tmp_path
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o666 & ~UMASK)
+        os.replace(tmp_path, filename)
+        fsync_directory(dirname(filename) or ".")
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Each visit export directory holds a manifest of every file exported into it
+MANIFEST_NAME = "manifest.jsonl"
+CHECKSUM_ALGORITHM = "blake2b"
+# Parsed manifests, keyed by manifest path; see get_manifest_index. This only
+# saves re-parsing within a process, e.g. between the formats of one run. What
+# carries over between runs is the manifest file itself.
+_manifest_indexes = {}
+_manifest_lock = threading.Lock()
+
+
+class HashingWriter(io.RawIOBase):
+    """
+    Raw binary writer that hashes and counts bytes as they pass through to `raw`.
+
+    Closing it does not close `raw`.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.hash = hashlib.new(CHECKSUM_ALGORITHM)
+        self.nbytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        n = self.raw.write(b)
+        self.hash.update(memoryview(b)[:n])
+        self.nbytes += n
+        return n
+
+
+def get_manifest_path(filename, manifest_path=None):
+    """
+    Get the manifest for an exported file.
+
+    Parameters
+    ----------
+    filename : str
+        The exported file.
+    manifest_path : str, optional
+        The manifest given by the caller, e.g. the visit manifest from
+        export_format. If None, the manifest beside `filename` is used, so
+        nothing is ever written outside the export folder.
+
+    Returns
+    -------
+    str
+        The manifest path.
+    """
+    if manifest_path is not None:
+        return os.path.abspath(manifest_path)
+    return join(dirname(os.path.abspath(filename)), MANIFEST_NAME)
+
+
+def read_manifest(manifest_path):
+    """
+    Read a visit manifest, keeping only the latest entry for each path.
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path to a manifest.jsonl file.
+
+    Returns
+    -------
+    dict
+        Mapping of path, relative to the visit directory, to its latest entry.
+    """
+    entries = {}
+    if not os.path.exists(manifest_path):
+        return entries
+    with open(manifest_path) as f:
+        for entry in parse_manifest_lines(f):
+            entries[entry["path"]] = entry
+    return entries
+
+
+def parse_manifest_lines(lines):
+    """
+    Yield the entries in manifest lines, skipping blank and truncated ones.
+    """
+    for line in lines:
+        line = line.strip()
+        if line == "":
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            # A line cut short by a crash while appending
+            continue
+
+
+def get_manifest_index(manifest_path):
+    """
+    Get the parsed manifest of a visit, reading only what was appended since the
+    last call.
+
+    The index is kept per worker process. Lines appended by this or any other
+    worker are read from the offset where the previous read stopped, so each
+    export costs one short read instead of a parse of the whole manifest.
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path to a manifest.jsonl file.
+
+    Returns
+    -------
+    dict
+        "entries", mapping each path to its latest entry, "checksums", mapping
+        each (algorithm, checksum) to the set of paths whose latest entry has it,
+        and "counts", mapping each top-level directory, i.e. format, to the number
+        of distinct paths in it.
+    """
+    with _manifest_lock:
+        index = _manifest_indexes.get(manifest_path)
+        try:
+            size = os.path.getsize(manifest_path)
+        except OSError:
+            size = 0
+        if index is None or size < index["offset"]:
+            # New, or replaced since it was last read
+            index = {"offset": 0, "entries": {}, "checksums": {}, "counts": {}}
+            _manifest_indexes[manifest_path] = index
+        if size == index["offset"]:
+            return index
+        with open(manifest_path, "rb") as f:
+            f.seek(index["offset"])
+            tail = f.read(size - index["offset"])
+        # Leave a line that is still being appended for the next read
+        tail = tail[: tail.rfind(b"\n") + 1]
+        index["offset"] += len(tail)
+        for entry in parse_manifest_lines(tail.decode().splitlines()):
+            previous = index["entries"].get(entry["path"])
+            if previous is not None:
+                key = (previous["algorithm"], previous["checksum"])
+                index["checksums"][key].discard(entry["path"])
+            else:
+                top = entry["path"].split("/", 1)[0]
+                index["counts"][top] = index["counts"].get(top, 0) + 1
+            index["entries"][entry["path"]] = entry
+            key = (entry["algorithm"], entry["checksum"])
+            index["checksums"].setdefault(key, set()).add(entry["path"])
+        return index
+
+
+def record_checksum(
+    filename, nbytes, checksum, uid=None, action="written", manifest_path=None
+):
+    """
+    Append an entry for an exported file to its visit manifest.
+
+    The manifest is JSON lines, one entry per export, so concurrent exports can
+    append to it. The latest entry for a path is the current one.
+
+    Parameters
+    ----------
+    filename : str
+        The exported file.
+    nbytes : int
+        The file size in bytes.
+    checksum : str
+        The hex digest of the file contents.
+    uid : str, optional
+        The uid of the run the file was exported from.
+    action : str, optional
+        "written", "unchanged" if an identical file was already in place, or
+        "linked" if it was hard-linked from an identical export.
+    manifest_path : str, optional
+        The manifest to append to, see get_manifest_path.
+    """
+    manifest_path = get_manifest_path(filename, manifest_path)
+    entry = {
+        "path": os.path.relpath(os.path.abspath(filename), dirname(manifest_path)),
+        "size": nbytes,
+        "algorithm": CHECKSUM_ALGORITHM,
+        "checksum": checksum,
+        "uid": uid,
+        "action": action,
+        "time": datetime.datetime.now().isoformat(),
+    }
+    with open(manifest_path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def find_identical_export(filename, nbytes, checksum, manifest_path=None):
+    """
+    Look up the visit manifest for an existing file with the given contents.
+
+    Parameters
+    ----------
+    filename : str
+        The file about to be exported.
+    nbytes : int
+        Its size in bytes.
+    checksum : str
+        The hex digest of its contents.
+    manifest_path : str, optional
+        The manifest to look in, see get_manifest_path.
+
+    Returns
+    -------
+    str or None
+        `filename` itself if it already has these contents, another exported file
+        with these contents, or None.
+    """
+    manifest_path = get_manifest_path(filename, manifest_path)
+    visit_path = dirname(manifest_path)
+    index = get_manifest_index(manifest_path)
+    rel_path = os.path.relpath(os.path.abspath(filename), visit_path)
+    with _manifest_lock:
+        paths = sorted(index["checksums"].get((CHECKSUM_ALGORITHM, checksum), ()))
+
+    def matches(path):
+        try:
+            return os.path.getsize(join(visit_path, path)) == nbytes
+        except OSError:
+            return False
+
+    if rel_path in paths and matches(rel_path):
+        return filename
+    for path in paths:
+        if path != rel_path and matches(path):
+            return join(visit_path, path)
+    return None
+
+
+def store_export(filename, data, checksum, uid=None, manifest_path=None):
+    """
+    Put export contents in place, skipping the write if they are already on disk.
+
+    If `filename` already holds identical contents, nothing is written. If another
+    export in the visit does, `filename` becomes a hard link to it. Otherwise the
+    data is written atomically. Either way the result is added to the manifest.
+    The manifest is bookkeeping only: if it can't be read or written, the file is
+    still exported and a warning is given.
+
+    Parameters
+    ----------
+    filename : str
+        The final path of the file.
+    data : bytes-like
+        The file contents, e.g. a BytesIO buffer view, which is not copied.
+    checksum : str
+        The hex digest of data.
+    uid : str, optional
+        The uid of the run being exported, recorded in the manifest.
+    manifest_path : str, optional
+        The manifest to record the file in, see get_manifest_path.
+
+    Returns
+    -------
+    str
+        The manifest action: "unchanged", "linked", or "written".
+    """
+    nbytes = memoryview(data).nbytes
+    try:
+        existing = find_identical_export(filename, nbytes, checksum, manifest_path)
+    except OSError as e:
+        warnings.warn(f"Could not read the export manifest, not deduplicating: {e}")
+        existing = None
+    action = "written"
+    if existing == filename:
+        action = "unchanged"
+    elif existing is not None:
+        # Unique per thread, as exports of one worker can run concurrently
+        link_path = join(
+            dirname(filename),
+            f".{basename(filename)}.{os.getpid()}.{threading.get_ident()}.link.tmp",
+        )
+        try:
+            os.link(existing, link_path)
+            os.replace(link_path, filename)
+            fsync_directory(dirname(filename) or ".")
+            action = "linked"
+        except OSError:
+            if os.path.exists(link_path):
+                os.remove(link_path)
+    if action == "written":
+        with atomic_write_path(filename) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+    try:
+        record_checksum(filename, nbytes, checksum, uid, action, manifest_path)
+    except OSError as e:
+        warnings.warn(f"Could not record {filename} in the export manifest: {e}")
+    return action
+
+
+@contextmanager
+def checksummed_open(filename, mode="w", compress=False, uid=None, manifest_path=None):
+    """
+    Open an export file for writing, with an inline checksum and deduplication.
+
+    Contents are buffered in memory and hashed as they are written, then passed
+    to store_export, which skips the write if identical contents are already on
+    disk.
+
+    Parameters
+    ----------
+    filename : str
+        The final path of the file being written.
+    mode : str, optional
+        "w" for text or "wb" for binary.
+    compress : bool, optional
+        If True, gzip the contents. The checksum is of the compressed bytes.
+    uid : str, optional
+        The uid of the run being exported, recorded in the manifest.
+    manifest_path : str, optional
+        The manifest to record the file in, see get_manifest_path.
+
+    Yields
+    ------
+    file
+        The open file.
+    """
+    buffer = io.BytesIO()
+    hashing = HashingWriter(buffer)
+    layers = [io.BufferedWriter(hashing)]
+    if compress:
+        # mtime=0 keeps the output identical for identical contents
+        layers.append(gzip.GzipFile(fileobj=layers[-1], mode="wb", mtime=0))
+    if "b" not in mode:
+        layers.append(io.TextIOWrapper(layers[-1]))
+    try:
+        yield layers[-1]
+    finally:
+        for layer in reversed(layers):
+            layer.close()
+    store_export(
+        filename, buffer.getbuffer(), hashing.hash.hexdigest(), uid, manifest_path
+    )
+
+
+def write_checksummed_bytes(filename, data, uid=None, manifest_path=None):
+    """
+    Export in-memory file contents with a checksum and deduplication.
+
+    Parameters
+    ----------
+    filename : str
+        The final path of the file being written.
+    data : bytes-like
+        The file contents, e.g. a BytesIO buffer view, which is not copied.
+    uid : str, optional
+        The uid of the run being exported, recorded in the manifest.
+    manifest_path : str, optional
+        The manifest to record the file in, see get_manifest_path.
+
+    Returns
+    -------
+    str
+        The manifest action: "unchanged", "linked", or "written".
+    """
+    checksum = hashlib.new(CHECKSUM_ALGORITHM, data).hexdigest()
+    return store_export(filename, data, checksum, uid, manifest_path)
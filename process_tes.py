@@ -1,5 +1,10 @@
 from prefect import flow, get_run_logger
-from export_tools import get_proposal_path, initialize_tiled_client
+from export_tools import (
+    PROCESS_INFO_PATH,
+    PROCESS_INFO_PATH_ENV,
+    get_proposal_path,
+    initialize_tiled_client,
+)
 from autoprocess.statelessAnalysis import handle_run
 from autoprocess.utils import get_processing_info_file
 from os.path import dirname, join
@@ -42,7 +47,7 @@ def process_tes(uid, beamline_acronym="ucal", reprocess=False):
         uid, catalog, save_directory, reprocess=reprocess
     )
     # Save calibration information
-    config_path = "/nsls2/data/sst/legacy/ucal/process_info"
+    config_path = os.environ.get(PROCESS_INFO_PATH_ENV, PROCESS_INFO_PATH)
     try:
         if "data_calibration_info" in processing_info:
             cal_path = get_processing_info_file(config_path, "calibration")
@@ -0,0 +1,502 @@
+"""
+Record a shift's runs into a local archive and replay them into end_of_run_workflow.
+
+    python replay_shift.py record ARCHIVE --since 2026-10-18T08:00 --until 2026-10-18T20:00
+    python replay_shift.py replay ARCHIVE --speed 10 --workers 4 --output summary.json
+
+The archive is a file-backed Tiled catalog (catalog.db and data/) holding the runs
+under <beamline>/raw, plus stop_docs.jsonl with each run's stop document in the
+order the runs ended. Replay serves the archive with a local Tiled server, points
+the workflow at it and at a scratch directory for exports and TES processing info,
+and releases each stop document at its recorded time, divided by --speed (0
+releases them all at once). Replay refuses to run if either path is under /nsls2.
+Unless PREFECT_API_URL is set, flows report to a temporary local Prefect server.
+Each workflow runs in a new process, as each production run gets a new container,
+so no per-worker cache carries over from one run to the next.
+
+Data that the source catalog only references externally, such as detector files,
+is recorded as the same reference, so those files must be reachable on replay.
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from os.path import join
+
+import numpy as np
+from tiled.client import from_uri
+from tiled.client.metadata_update import DELETE_KEY
+from tiled.client.sync import copy
+from tiled.queries import Key
+
+from export_tools import (
+    PROCESS_INFO_PATH_ENV,
+    PROPOSALS_ROOT_ENV,
+    TILED_URI_ENV,
+    initialize_tiled_client,
+)
+
+STOP_DOCS_NAME = "stop_docs.jsonl"
+# Set on a run's archive node while it is being copied, so only nodes left partial
+# by an interrupted recording are ever deleted
+RECORDING_KEY = "replay_shift_recording"
+PERCENTILES = (50, 90, 99)
+# Prefect returns at most this many runs per request
+PAGE_SIZE = 200
+# Replays never write under this directory
+PRODUCTION_ROOT = "/nsls2"
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def serve_archive(archive_path, timeout=60):
+    """
+    Serve an archive's catalog with a local Tiled server for the duration.
+
+    Yields
+    ------
+    tuple
+        (uri, api key)
+    """
+    os.makedirs(join(archive_path, "data"), exist_ok=True)
+    port = get_free_port()
+    api_key = secrets.token_hex(16)
+    uri = f"http://127.0.0.1:{port}"
+    command = [
+        "tiled",
+        "serve",
+        "catalog",
+        join(archive_path, "catalog.db"),
+        "--write",
+        join(archive_path, "data"),
+        "--init",
+        "--api-key",
+        api_key,
+        "--port",
+        str(port),
+    ]
+    server = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                from_uri(uri, api_key=api_key)
+                break
+            except Exception:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"Tiled server for {archive_path} did not start")
+                time.sleep(0.5)
+        yield uri, api_key
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def get_archive_node(client, beamline_acronym, node="raw"):
+    """
+    Get the <beamline>/<node> container of an archive, creating it if needed.
+    """
+    for key in (beamline_acronym, node):
+        if key not in client:
+            client.create_container(key=key)
+        client = client[key]
+    return client
+
+
+def read_stop_docs(archive_path):
+    stop_docs = []
+    with open(join(archive_path, STOP_DOCS_NAME)) as f:
+        for line in f:
+            if line.strip():
+                stop_docs.append(json.loads(line))
+    return stop_docs
+
+
+def record_stop_doc(stop_docs_path, stop_doc, stop_docs, recorded):
+    # Appended as each run is recorded, so an interrupted recording keeps the
+    # runs it finished; record_shift sorts the file by time at the end
+    with open(stop_docs_path, "a") as f:
+        f.write(json.dumps(stop_doc) + "\n")
+    stop_docs.append(stop_doc)
+    recorded.add(stop_doc["run_start"])
+
+
+def record_shift(archive_path, since, until, beamline_acronym="ucal", source=None):
+    """
+    Copy every finished run that started within a time range into an archive.
+
+    Runs already in the archive are skipped, so an interrupted recording can be
+    resumed. A run whose copy was interrupted is copied again; nothing else in
+    the archive is deleted.
+
+    Parameters
+    ----------
+    archive_path : str
+        The archive directory, created if needed.
+    since : float
+        Start of the shift, as a Unix timestamp.
+    until : float
+        End of the shift, as a Unix timestamp.
+    beamline_acronym : str, optional
+        Beamline identifier.
+    source : tiled node, optional
+        The catalog to record from. Defaults to initialize_tiled_client.
+
+    Returns
+    -------
+    int
+        The number of runs in the archive.
+    """
+    if source is None:
+        source = initialize_tiled_client(beamline_acronym)
+    runs = source.search(Key("start.time") >= since).search(Key("start.time") < until)
+    os.makedirs(archive_path, exist_ok=True)
+    stop_docs_path = join(archive_path, STOP_DOCS_NAME)
+    stop_docs = read_stop_docs(archive_path) if os.path.exists(stop_docs_path) else []
+    recorded = {stop_doc["run_start"] for stop_doc in stop_docs}
+
+    with serve_archive(archive_path) as (uri, api_key):
+        archive = get_archive_node(from_uri(uri, api_key=api_key), beamline_acronym)
+        for uid, run in runs.items():
+            stop_doc = run.metadata.get("stop")
+            if stop_doc is None:
+                print(f"Run {uid} has not finished, skipping")
+                continue
+            if uid in recorded:
+                continue
+            stop_doc = json.loads(json.dumps(stop_doc, default=dict))
+            if uid in archive:
+                if not archive[uid].metadata.get(RECORDING_KEY):
+                    # Copied in full before the recording was interrupted
+                    print(f"Run {uid} is already in the archive, keeping it")
+                    record_stop_doc(stop_docs_path, stop_doc, stop_docs, recorded)
+                    continue
+                # Left partial by an interrupted recording
+                archive.delete_contents(uid, recursive=True, external_only=False)
+            scan_id = run.metadata.get("start", {}).get("scan_id")
+            print(f"Recording scan {scan_id} ({uid})")
+            node = archive.create_container(
+                key=uid,
+                metadata={**run.metadata, RECORDING_KEY: True},
+                specs=run.specs,
+            )
+            copy(run, node)
+            node.update_metadata(
+                metadata={RECORDING_KEY: DELETE_KEY}, drop_revision=True
+            )
+            record_stop_doc(stop_docs_path, stop_doc, stop_docs, recorded)
+
+    stop_docs.sort(key=lambda stop_doc: stop_doc["time"])
+    with open(stop_docs_path, "w") as f:
+        for stop_doc in stop_docs:
+            f.write(json.dumps(stop_doc) + "\n")
+    print(f"Archive {archive_path} holds {len(stop_docs)} runs")
+    return len(stop_docs)
+
+
+def get_release_times(stop_docs, speed=1.0):
+    """
+    Seconds after the start of a replay at which each stop document is released.
+
+    Parameters
+    ----------
+    stop_docs : list of dict
+        Stop documents, in the order they are released.
+    speed : float, optional
+        How many times faster than real time to replay. 0 releases everything at
+        once.
+    """
+    if speed <= 0 or not stop_docs:
+        return [0.0] * len(stop_docs)
+    first = stop_docs[0]["time"]
+    return [max(0.0, (stop_doc["time"] - first) / speed) for stop_doc in stop_docs]
+
+
+def summarize(values):
+    if len(values) == 0:
+        return {}
+    summary = {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+    summary["max"] = float(np.max(values))
+    summary["count"] = len(values)
+    return summary
+
+
+def _read_all(read, **kwargs):
+    items = []
+    while True:
+        page = read(limit=PAGE_SIZE, offset=len(items), **kwargs)
+        items.extend(page)
+        if len(page) < PAGE_SIZE:
+            return items
+
+
+def get_stage_latencies(since):
+    """
+    Durations of every Prefect flow and task run that started after a time, by
+    flow or task name.
+
+    Returns
+    -------
+    dict
+        Mapping of stage name to summarize() of its durations in seconds.
+    """
+    from prefect.client.orchestration import get_client
+    from prefect.client.schemas.filters import (
+        FlowRunFilter,
+        FlowRunFilterStartTime,
+        TaskRunFilter,
+        TaskRunFilterStartTime,
+    )
+
+    durations = {}
+    with get_client(sync_client=True) as client:
+        flow_runs = _read_all(
+            client.read_flow_runs,
+            flow_run_filter=FlowRunFilter(
+                start_time=FlowRunFilterStartTime(after_=since)
+            ),
+        )
+        task_runs = _read_all(
+            client.read_task_runs,
+            task_run_filter=TaskRunFilter(
+                start_time=TaskRunFilterStartTime(after_=since)
+            ),
+        )
+        flow_names = {}
+        for flow_run in flow_runs:
+            if flow_run.flow_id not in flow_names:
+                flow_names[flow_run.flow_id] = client.read_flow(flow_run.flow_id).name
+    for flow_run in flow_runs:
+        if flow_run.start_time is not None and flow_run.end_time is not None:
+            name = f"flow:{flow_names[flow_run.flow_id]}"
+            elapsed = (flow_run.end_time - flow_run.start_time).total_seconds()
+            durations.setdefault(name, []).append(elapsed)
+    for task_run in task_runs:
+        if task_run.start_time is not None and task_run.end_time is not None:
+            # Task run names are the task name with a short random suffix
+            name = f"task:{task_run.name.rsplit('-', 1)[0]}"
+            elapsed = (task_run.end_time - task_run.start_time).total_seconds()
+            durations.setdefault(name, []).append(elapsed)
+    return {name: summarize(values) for name, values in sorted(durations.items())}
+
+
+def check_scratch_paths(paths):
+    """
+    Refuse to replay if any path the workflow writes to is under PRODUCTION_ROOT.
+
+    Parameters
+    ----------
+    paths : dict
+        Mapping of environment variable name to the path it will be set to.
+
+    Raises
+    ------
+    RuntimeError
+        If a path resolves to PRODUCTION_ROOT or a directory under it.
+    """
+    for name, path in paths.items():
+        real_path = os.path.realpath(path)
+        if os.path.commonpath([real_path, PRODUCTION_ROOT]) == PRODUCTION_ROOT:
+            raise RuntimeError(
+                f"Refusing to replay with {name}={path}, which is under "
+                f"{PRODUCTION_ROOT}"
+            )
+
+
+def run_one(stop_doc, release):
+    """
+    Run end_of_run_workflow for one stop document.
+
+    Parameters
+    ----------
+    stop_doc : dict
+        The stop document to run the workflow for.
+    release : float
+        When the stop document was released, as a Unix timestamp.
+
+    Returns
+    -------
+    tuple
+        (queue delay, latency, final state name), with times in seconds since
+        release.
+    """
+    from end_of_run_workflow import end_of_run_workflow
+
+    started = time.time()
+    state = end_of_run_workflow(stop_doc, return_state=True)
+    return started - release, time.time() - release, state.name
+
+
+def replay_shift(archive_path, speed=1.0, workers=4, limit=None, export_root=None):
+    """
+    Replay an archive's stop documents into end_of_run_workflow.
+
+    Each stop document is released at its recorded time, scaled by speed, onto a
+    pool of workers. Every workflow runs in a new process, so the queue delay
+    includes process start-up, as a new container's would.
+
+    Parameters
+    ----------
+    archive_path : str
+        An archive written by record_shift.
+    speed : float, optional
+        How many times faster than real time to replay. 0 releases everything at
+        once.
+    workers : int, optional
+        Number of workflows run at once.
+    limit : int, optional
+        Replay only the first limit runs.
+    export_root : str, optional
+        Scratch directory that exports and TES processing info are written under.
+        Defaults to a temporary directory that is removed afterwards.
+
+    Returns
+    -------
+    dict
+        "runs", "failed", "wall_time" and "throughput" (runs per minute),
+        "queue_delay" (release to start) and "latency" (release to finish)
+        percentiles in seconds, "states" (count of each final state), and
+        "stages" (per flow and task duration percentiles from Prefect).
+    """
+    stop_docs = read_stop_docs(archive_path)[:limit]
+    releases = get_release_times(stop_docs, speed)
+
+    with ExitStack() as stack:
+        if export_root is None:
+            export_root = stack.enter_context(tempfile.TemporaryDirectory())
+        scratch_paths = {
+            PROPOSALS_ROOT_ENV: export_root,
+            PROCESS_INFO_PATH_ENV: join(export_root, "process_info"),
+        }
+        check_scratch_paths(scratch_paths)
+
+        uri, api_key = stack.enter_context(serve_archive(archive_path))
+        os.environ[TILED_URI_ENV] = uri
+        os.environ["TILED_API_KEY"] = api_key
+        os.environ.update(scratch_paths)
+
+        if not os.environ.get("PREFECT_API_URL"):
+            from prefect.settings import PREFECT_API_URL
+            from prefect.testing.utilities import prefect_test_harness
+
+            stack.enter_context(prefect_test_harness())
+            # The worker processes find the temporary server through the environment
+            os.environ["PREFECT_API_URL"] = PREFECT_API_URL.value()
+            stack.callback(os.environ.pop, "PREFECT_API_URL", None)
+
+        since = datetime.datetime.now(datetime.timezone.utc)
+        start_time = time.time()
+        futures = []
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=1,
+        ) as executor:
+            for stop_doc, release in zip(stop_docs, releases):
+                delay = start_time + release - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(executor.submit(run_one, stop_doc, start_time + release))
+        results = [future.result() for future in futures]
+        wall_time = time.time() - start_time
+        stages = get_stage_latencies(since)
+
+    queue_delays = [queue_delay for queue_delay, _, _ in results]
+    latencies = [latency for _, latency, _ in results]
+    states = {}
+    for _, _, state in results:
+        states[state] = states.get(state, 0) + 1
+    return {
+        "runs": len(results),
+        "failed": len(results) - states.get("Completed", 0),
+        "wall_time": wall_time,
+        "throughput": 60 * len(results) / wall_time if wall_time > 0 else 0.0,
+        "queue_delay": summarize(queue_delays),
+        "latency": summarize(latencies),
+        "states": states,
+        "stages": stages,
+    }
+
+
+def print_summary(summary):
+    print(
+        f"\n{summary['runs']} runs in {summary['wall_time']:.1f} s "
+        f"({summary['throughput']:.2f} runs/min), {summary['failed']} not completed"
+    )
+    print(f"Final states: {summary['states']}")
+    columns = [f"p{p}" for p in PERCENTILES] + ["max"]
+    print(f"\n{'seconds':<40}" + "".join(f"{c:>10}" for c in columns) + "     count")
+    rows = [("queue delay", summary["queue_delay"]), ("latency", summary["latency"])]
+    rows += list(summary["stages"].items())
+    for name, stats in rows:
+        if stats:
+            print(
+                f"{name:<40}"
+                + "".join(f"{stats[c]:>10.2f}" for c in columns)
+                + f"{stats['count']:>10}"
+            )
+
+
+def parse_time(value):
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Record a shift's runs and replay them into end_of_run_workflow"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="record a shift")
+    record_parser.add_argument("archive_path")
+    record_parser.add_argument("--since", type=parse_time, required=True)
+    record_parser.add_argument("--until", type=parse_time, required=True)
+    record_parser.add_argument("--beamline", default="ucal")
+
+    replay_parser = subparsers.add_parser("replay", help="replay a recorded shift")
+    replay_parser.add_argument("archive_path")
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="times faster than real time; 0 releases every run at once",
+    )
+    replay_parser.add_argument("--workers", type=int, default=4)
+    replay_parser.add_argument("--limit", type=int, default=None)
+    replay_parser.add_argument(
+        "--export-root",
+        default=None,
+        help="keep exports and TES processing info under this directory",
+    )
+    replay_parser.add_argument("--output", default=None, help="write a JSON summary")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record_shift(args.archive_path, args.since, args.until, args.beamline)
+        sys.exit(0)
+
+    summary = replay_shift(
+        args.archive_path, args.speed, args.workers, args.limit, args.export_root
+    )
+    print_summary(summary)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    sys.exit(1 if summary["failed"] else 0)
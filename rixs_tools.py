@@ -0,0 +1,275 @@
+import numpy as np
+
+# Bin widths for each RIXS map, as multiples of the native incident and emission
+# spacing of the data, from finest to coarsest
+RIXS_RESOLUTIONS = (1, 2, 4)
+# Number of scan points regridded at a time
+RIXS_CHUNK_POINTS = 256
+# Maximum number of bins along either axis of the finest map
+RIXS_MAX_BINS = 2048
+
+
+def uniform_edges(values, width):
+    """
+    Make uniform bin edges of a given width that cover all finite values.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The values to cover.
+    width : float
+        The bin width.
+
+    Returns
+    -------
+    np.ndarray
+        The bin edges, aligned to multiples of width.
+    """
+    lo = np.floor(np.nanmin(values) / width) * width
+    hi = np.nanmax(values)
+    nbins = max(1, int(np.floor((hi - lo) / width)) + 1)
+    return lo + width * np.arange(nbins + 1)
+
+
+def native_spacing(values):
+    """
+    Typical step between consecutive values, in acquisition order.
+
+    This is the median absolute difference between consecutive distinct values, so
+    repeated sweeps and readback jitter do not shrink it the way the gaps between
+    sorted unique values would. It is never less than the range divided by the
+    number of steps, so the bins of one map cannot outnumber the values. Returns 1
+    if there is only one distinct value.
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    steps = np.abs(np.diff(values))
+    steps = steps[steps > 0]
+    if len(steps) == 0:
+        return 1.0
+    span = float(values.max() - values.min())
+    return max(float(np.median(steps)), span / len(steps))
+
+
+def get_span(values):
+    finite = values[np.isfinite(values)]
+    return float(finite.max() - finite.min()) if len(finite) else 0.0
+
+
+def accumulate_rixs_map(
+    counts, incident, emission, weights, incident_edges, emission_edges
+):
+    """
+    Add weighted samples into a RIXS map, in place.
+
+    The edges must be uniform, so each sample's bin is computed arithmetically and
+    accumulated with a single np.bincount, without searching or Python loops.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        The (incident, emission) map to add to.
+    incident : np.ndarray
+        Incident energy of each sample.
+    emission : np.ndarray
+        Emission energy of each sample.
+    weights : np.ndarray or None
+        Weight of each sample, or None to count each sample once.
+    incident_edges : np.ndarray
+        Uniform incident bin edges.
+    emission_edges : np.ndarray
+        Uniform emission bin edges.
+
+    Returns
+    -------
+    np.ndarray
+        The updated counts.
+    """
+    n_inc = len(incident_edges) - 1
+    n_em = len(emission_edges) - 1
+    inc_width = incident_edges[1] - incident_edges[0]
+    em_width = emission_edges[1] - emission_edges[0]
+    i = np.floor((incident - incident_edges[0]) / inc_width)
+    j = np.floor((emission - emission_edges[0]) / em_width)
+    valid = (i >= 0) & (i < n_inc) & (j >= 0) & (j < n_em)
+    if weights is not None:
+        valid &= np.isfinite(weights)
+        weights = weights[valid]
+    index = i[valid].astype(np.int64) * n_em + j[valid].astype(np.int64)
+    counts += np.bincount(index, weights=weights, minlength=n_inc * n_em).reshape(
+        n_inc, n_em
+    )
+    return counts
+
+
+def regrid_spectra(
+    spectra,
+    incident_values,
+    emission_values,
+    incident_edges,
+    emission_edges,
+    chunk_points=RIXS_CHUNK_POINTS,
+):
+    """
+    Regrid per-point TES spectra onto a RIXS map, a chunk of scan points at a time.
+
+    Parameters
+    ----------
+    spectra : np.ndarray
+        The (point, emission) spectra.
+    incident_values : np.ndarray
+        Incident energy at each scan point.
+    emission_values : np.ndarray
+        Emission energy of each spectrum bin.
+    incident_edges : np.ndarray
+        Uniform incident bin edges.
+    emission_edges : np.ndarray
+        Uniform emission bin edges.
+    chunk_points : int, optional
+        Number of scan points regridded at a time.
+
+    Returns
+    -------
+    np.ndarray
+        The (incident, emission) map.
+    """
+    counts = np.zeros((len(incident_edges) - 1, len(emission_edges) - 1))
+    n_em = len(emission_values)
+    for start in range(0, len(spectra), chunk_points):
+        block = np.asarray(spectra[start : start + chunk_points], dtype=float)
+        npts = block.shape[0]
+        incident = np.repeat(incident_values[start : start + npts], n_em)
+        emission = np.tile(emission_values, npts)
+        accumulate_rixs_map(
+            counts, incident, emission, block.ravel(), incident_edges, emission_edges
+        )
+    return counts
+
+
+def is_rixs_grid(data):
+    """
+    Whether "rixs" column data is a (counts, mono_grid, energy_grid) tuple, rather
+    than a (point, emission) array of spectra, which may also have three points.
+    """
+    return isinstance(data, tuple) and len(data) == 3
+
+
+def get_rixs_spectra(columns, run_data, metadata):
+    """
+    Get the RIXS spectra and their axes from normalized run data.
+
+    Parameters
+    ----------
+    columns : list
+        The column names, as returned by get_xdi_normalized_data.
+    run_data : list
+        The column data, in the same order as columns.
+    metadata : dict
+        The XDI header, used for the scan motor and the "rois.rixs" energy range.
+
+    Returns
+    -------
+    tuple or None
+        (spectra, incident_values, emission_values), with spectra shaped
+        (point, emission), or None if the run has no usable RIXS data.
+    """
+    if "rixs" not in columns or len(columns) < 2:
+        return None
+    data = run_data[columns.index("rixs")]
+    if is_rixs_grid(data):
+        counts, mono_grid, energy_grid = data
+        return np.asarray(counts).T, mono_grid[0, :], energy_grid[:, 0]
+    spectra = np.asarray(data)
+    if spectra.ndim != 2:
+        return None
+    motor = metadata.get("Scan.motors", "time")
+    motor_index = columns.index(motor) if motor in columns else 0
+    incident_values = np.asarray(run_data[motor_index], dtype=float)
+    roi = str(metadata.get("rois.rixs", "")).split()
+    if len(roi) == 2:
+        lo, hi = float(roi[0]), float(roi[1])
+        step = (hi - lo) / spectra.shape[1]
+        emission_values = lo + step * (np.arange(spectra.shape[1]) + 0.5)
+    else:
+        emission_values = np.arange(spectra.shape[1], dtype=float)
+    return spectra, incident_values, emission_values
+
+
+def make_rixs_maps(
+    columns,
+    run_data,
+    metadata,
+    resolutions=RIXS_RESOLUTIONS,
+    bin_widths=None,
+    chunk_points=RIXS_CHUNK_POINTS,
+    max_bins=RIXS_MAX_BINS,
+):
+    """
+    Regrid a run's TES spectra into incident x emission maps at several resolutions.
+
+    Parameters
+    ----------
+    columns : list
+        The column names, as returned by get_xdi_normalized_data.
+    run_data : list
+        The column data, in the same order as columns.
+    metadata : dict
+        The XDI header.
+    resolutions : tuple of float, optional
+        Bin widths as multiples of the native spacing, or of the span divided by
+        max_bins if that is coarser. Ignored if bin_widths is given.
+    bin_widths : list of (float, float), optional
+        Explicit (incident, emission) bin widths, one pair per map.
+    chunk_points : int, optional
+        Number of scan points regridded at a time.
+    max_bins : int, optional
+        Maximum number of bins along either axis of the finest map. Ignored if
+        bin_widths is given.
+
+    Returns
+    -------
+    list of dict
+        One dict per map with "counts" (incident, emission), "incident_energies",
+        "emission_energies", "incident_width" and "emission_width". Empty if the
+        run has no usable RIXS data.
+    """
+    rixs = get_rixs_spectra(columns, run_data, metadata)
+    if rixs is None:
+        return []
+    spectra, incident_values, emission_values = rixs
+    if not np.any(np.isfinite(incident_values)):
+        return []
+    if bin_widths is None:
+        # uniform_edges aligns the first edge to a multiple of the width, which
+        # can add up to two bins beyond span / width
+        max_steps = max(1, max_bins - 2)
+        inc_step = max(
+            native_spacing(incident_values), get_span(incident_values) / max_steps
+        )
+        em_step = max(
+            native_spacing(emission_values), get_span(emission_values) / max_steps
+        )
+        bin_widths = [(inc_step * r, em_step * r) for r in resolutions]
+
+    maps = []
+    for incident_width, emission_width in bin_widths:
+        incident_edges = uniform_edges(incident_values, incident_width)
+        emission_edges = uniform_edges(emission_values, emission_width)
+        counts = regrid_spectra(
+            spectra,
+            incident_values,
+            emission_values,
+            incident_edges,
+            emission_edges,
+            chunk_points,
+        )
+        maps.append(
+            {
+                "counts": counts,
+                "incident_energies": (incident_edges[:-1] + incident_edges[1:]) / 2,
+                "emission_energies": (emission_edges[:-1] + emission_edges[1:]) / 2,
+                "incident_width": incident_width,
+                "emission_width": emission_width,
+            }
+        )
+    return maps
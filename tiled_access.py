@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+
+from export_tools import get_config_values, get_primary_keys
+
+# Maximum number of Tiled requests in flight for one run
+MAX_CONCURRENT_READS = 8
+
+
+async def _read(semaphore, func, *args):
+    # The tiled client is synchronous; run each request in a thread so that
+    # several can wait on the network at once
+    async with semaphore:
+        return await asyncio.to_thread(func, *args)
+
+
+def _read_primary(run, omit_array_keys):
+    usekeys = get_primary_keys(run, omit_array_keys)
+    return usekeys, run.primary.data.read(usekeys)
+
+
+def _read_nbytes(run, stream):
+    # Only the size leaves the thread, so each stream's data can be freed as soon
+    # as it has been read
+    return run[stream].read().nbytes
+
+
+async def read_stream_async(run, stream, semaphore):
+    """
+    Read one stream of a run, keeping only its size.
+
+    Returns
+    -------
+    tuple
+        (stream nbytes, elapsed seconds)
+    """
+    start_time = time.monotonic()
+    nbytes = await _read(semaphore, _read_nbytes, run, stream)
+    return nbytes, time.monotonic() - start_time
+
+
+async def read_streams_async(run, streams=None, max_concurrent=MAX_CONCURRENT_READS):
+    """
+    Read several streams of a run concurrently, to check that they can be read.
+
+    Parameters
+    ----------
+    run : Run
+    streams : list of str, optional
+        The streams to read. Defaults to every stream in the run.
+    max_concurrent : int, optional
+        Maximum number of requests in flight.
+
+    Returns
+    -------
+    dict
+        Mapping of stream name to (stream nbytes, elapsed seconds).
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+    if streams is None:
+        streams = list(run)
+    results = await asyncio.gather(
+        *[read_stream_async(run, stream, semaphore) for stream in streams]
+    )
+    return dict(zip(streams, results))
+
+
+async def read_run_async(
+    run, omit_array_keys=True, max_concurrent=MAX_CONCURRENT_READS
+):
+    """
+    Read everything the exporters need from a run, with requests issued concurrently.
+
+    Parameters
+    ----------
+    run : Run
+    omit_array_keys : bool, optional
+        If True, leave known array keys out of the primary read.
+    max_concurrent : int, optional
+        Maximum number of requests in flight.
+
+    Returns
+    -------
+    dict
+        "baseline" (baseline data), "primary_keys" and "primary" (primary keys and
+        data), and "config" (baseline configuration values from get_config_values).
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+    baseline, primary, config = await asyncio.gather(
+        _read(semaphore, run.baseline.data.read),
+        _read(semaphore, _read_primary, run, omit_array_keys),
+        _read(semaphore, get_config_values, run.baseline),
+    )
+    reads = {}
+    reads["baseline"] = baseline
+    reads["primary_keys"], reads["primary"] = primary
+    reads["config"] = config
+    return reads
+
+
+def run_sync(coroutine):
+    """
+    Run a coroutine to completion from synchronous code.
+
+    If this thread already has a running event loop, e.g. inside an async flow,
+    the coroutine runs on a new loop in a helper thread instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    result = {}
+
+    def target():
+        try:
+            result["value"] = asyncio.run(coroutine)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def read_streams(run, streams=None, max_concurrent=MAX_CONCURRENT_READS):
+    """
+    Synchronous wrapper for read_streams_async.
+    """
+    return run_sync(read_streams_async(run, streams, max_concurrent))
+
+
+def read_run(run, omit_array_keys=True, max_concurrent=MAX_CONCURRENT_READS):
+    """
+    Synchronous wrapper for read_run_async.
+    """
+    return run_sync(read_run_async(run, omit_array_keys, max_concurrent))
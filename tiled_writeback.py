@@ -0,0 +1,611 @@
+import dataclasses
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from prefect import flow, get_run_logger
+from tiled.client.metadata_update import DELETE_KEY
+from tiled.queries import Contains, Key
+from tiled.structures.array import ArrayStructure
+from tiled.structures.core import StructureFamily
+from tiled.structures.data_source import DataSource
+from tiled.structures.table import TableStructure
+
+from export_to_tiled import export_to_tiled
+from export_tools import initialize_tiled_client
+
+# Target upload size per request. Arrays smaller than this go up in one request.
+CHUNK_NBYTES = 8_000_000
+# Key of the table holding every 1-D variable along "time"
+COLUMNS_KEY = "columns"
+# Metadata key set on a scan once every part of it has been uploaded
+COMPLETE_KEY = "writeback_complete"
+# Metadata key holding the time an upload was started
+STARTED_KEY = "writeback_started"
+# Metadata key listing the uids of the scans in a batch table
+UIDS_KEY = "uids"
+# Metadata key of the processed container recording runs that failed to upload
+FAILURES_KEY = "writeback_failures"
+# Scans with only 1-D columns and at most this many bytes are uploaded in batches,
+# as rows of one table shared with other scans of the same columns
+SMALL_SCAN_NBYTES = CHUNK_NBYTES // 8
+# Maximum number of scans in one batch table
+BATCH_MAX_SCANS = 100
+# An upload not completed after this long is treated as abandoned and removed
+STALE_SECONDS = 3600
+# A run that failed to upload is retried after this delay, doubled for each
+# further failure up to FAILURE_BACKOFF_MAX_SECONDS
+FAILURE_BACKOFF_SECONDS = 1800
+FAILURE_BACKOFF_MAX_SECONDS = 86400
+
+
+def with_retries(func, *args, retries=3, retry_delay_seconds=1, **kwargs):
+    """
+    Call func, retrying with exponential backoff if it raises.
+
+    Parameters
+    ----------
+    func : callable
+        The function to call.
+    retries : int, optional
+        Number of retries after the first failure.
+    retry_delay_seconds : float, optional
+        Delay before the first retry; doubled for each further retry.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(retry_delay_seconds * 2**attempt)
+
+
+def get_upload_chunks(shape, itemsize, chunk_nbytes=CHUNK_NBYTES):
+    """
+    Split an array along its first axis into blocks of roughly chunk_nbytes.
+
+    Parameters
+    ----------
+    shape : tuple
+        The array shape.
+    itemsize : int
+        Bytes per element.
+    chunk_nbytes : int, optional
+        Target bytes per block.
+
+    Returns
+    -------
+    tuple of tuples
+        Dask-style chunks.
+    """
+    if len(shape) == 0:
+        return ()
+    row_nbytes = itemsize * int(np.prod(shape[1:]))
+    rows = max(1, chunk_nbytes // max(1, row_nbytes))
+    first = tuple(min(rows, shape[0] - start) for start in range(0, shape[0], rows))
+    return (first or (0,),) + tuple((n,) for n in shape[1:])
+
+
+def iter_blocks(chunks):
+    """
+    Yield (block index, slices) for every block of a chunked array.
+    """
+    offsets = [np.cumsum((0,) + tuple(c)) for c in chunks]
+    for block in itertools.product(*[range(len(c)) for c in chunks]):
+        slices = tuple(slice(off[i], off[i + 1]) for off, i in zip(offsets, block))
+        yield block, slices
+
+
+def split_columns(ds):
+    """
+    Separate the variables that can share one table from those that need arrays.
+
+    Returns
+    -------
+    columns : list of str
+        1-D variables along "time", uploaded together as one table.
+    arrays : list of str
+        Every other variable, uploaded as its own array node.
+    """
+    columns = []
+    arrays = []
+    for name, variable in ds.variables.items():
+        # Table column names may not start with an underscore
+        if variable.dims == ("time",) and not str(name).startswith("_"):
+            columns.append(name)
+        else:
+            arrays.append(name)
+    return columns, arrays
+
+
+def upload_table(node, ds, columns, chunk_nbytes=CHUNK_NBYTES):
+    """
+    Upload 1-D variables as the columns of one table, in row partitions of roughly
+    chunk_nbytes, so a scan with thousands of ROI columns costs a few requests
+    instead of several per column.
+
+    Returns
+    -------
+    int
+        The number of requests made.
+    """
+    df = pd.DataFrame({name: np.asarray(ds.variables[name].data) for name in columns})
+    row_nbytes = max(1, int(df.memory_usage(index=False).sum()) // max(1, len(df)))
+    rows = max(1, chunk_nbytes // row_nbytes)
+    starts = range(0, max(1, len(df)), rows)
+    structure = dataclasses.replace(
+        TableStructure.from_pandas(df), npartitions=len(starts)
+    )
+    table_client = with_retries(
+        node.new,
+        StructureFamily.table,
+        [DataSource(structure_family=StructureFamily.table, structure=structure)],
+        key=COLUMNS_KEY,
+        metadata={
+            "dims": ["time"],
+            "coords": [name for name in columns if name in ds.coords],
+            "attrs": {name: dict(ds.variables[name].attrs) for name in columns},
+        },
+    )
+    for partition, start in enumerate(starts):
+        part = df.iloc[start : start + rows].reset_index(drop=True)
+        with_retries(table_client.write_partition, partition, part)
+    return 1 + len(starts)
+
+
+def upload_array(node, name, variable, spec, chunk_nbytes=CHUNK_NBYTES):
+    """
+    Create an array node for one dataset variable and upload its blocks.
+
+    Parameters
+    ----------
+    node : Container
+        The tiled container for the scan.
+    name : str
+        The variable name, used as the array key.
+    variable : xr.Variable
+        The variable to upload. Dask-backed variables keep their own chunks.
+    spec : str
+        "xarray_coord" or "xarray_data_var".
+    chunk_nbytes : int, optional
+        Target bytes per block for numpy-backed variables.
+
+    Returns
+    -------
+    int
+        The number of requests made.
+    """
+    data = variable.data
+    chunks = getattr(data, "chunks", None)
+    if chunks is None:
+        chunks = get_upload_chunks(data.shape, data.dtype.itemsize, chunk_nbytes)
+    structure = ArrayStructure.from_array(data, chunks=chunks, dims=variable.dims)
+    array_client = with_retries(
+        node.new,
+        StructureFamily.array,
+        [DataSource(structure_family=StructureFamily.array, structure=structure)],
+        key=name,
+        metadata={"attrs": dict(variable.attrs)},
+        specs=[spec],
+    )
+    nblocks = 0
+    for block, slices in iter_blocks(chunks):
+        with_retries(array_client.write_block, np.asarray(data[slices]), block)
+        nblocks += 1
+    return 1 + nblocks
+
+
+def submit_dataset(container, key, ds, metadata, executor, chunk_nbytes=CHUNK_NBYTES):
+    """
+    Create a container for one scan and submit all of its variables for upload.
+
+    The 1-D variables go up together as one table; every other variable is
+    created and uploaded as its own array node. Node creation happens in the
+    pool along with the data, so uploads of different scans overlap.
+
+    Parameters
+    ----------
+    container : Container
+        The processed tiled container to write into.
+    key : str
+        The key for the scan, normally its uid.
+    ds : xr.Dataset
+        The dataset returned by export_to_tiled.
+    metadata : dict
+        The metadata returned by export_to_tiled.
+    executor : ThreadPoolExecutor
+        The pool shared by all uploads.
+    chunk_nbytes : int, optional
+        Target bytes per block or table partition.
+
+    Returns
+    -------
+    list of Future
+        One future per table or array, each returning its number of requests.
+    """
+    node = with_retries(
+        container.create_container,
+        key,
+        metadata={
+            **metadata,
+            "attrs": dict(ds.attrs),
+            COMPLETE_KEY: False,
+            STARTED_KEY: time.time(),
+        },
+    )
+    columns, arrays = split_columns(ds)
+    futures = []
+    if columns:
+        futures.append(executor.submit(upload_table, node, ds, columns, chunk_nbytes))
+    for name in arrays:
+        spec = "xarray_coord" if name in ds.coords else "xarray_data_var"
+        futures.append(
+            executor.submit(
+                upload_array, node, name, ds.variables[name], spec, chunk_nbytes
+            )
+        )
+    return futures
+
+
+def get_batch_schema(ds):
+    """
+    Get the column layout a small scan is batched by, or None if it is too large or
+    has variables that are not 1-D columns.
+    """
+    columns, arrays = split_columns(ds)
+    if arrays or not columns or ds.nbytes > SMALL_SCAN_NBYTES:
+        return None
+    return tuple((name, str(ds.variables[name].dtype)) for name in columns)
+
+
+def get_batch_key(scans):
+    """
+    Key of the table for a batch of scans, named after its first scan.
+    """
+    return f"batch-{scans[0][0]}"
+
+
+def upload_batch(container, key, scans, chunk_nbytes=CHUNK_NBYTES):
+    """
+    Upload several small scans that share a column layout as the rows of one table.
+
+    The scans are concatenated in order. Each scan's metadata, attributes and row
+    range are kept in the table metadata under "scans", and their uids under
+    UIDS_KEY, so a batch of scans costs a few requests instead of several each.
+
+    Parameters
+    ----------
+    container : Container
+        The processed tiled container to write into.
+    key : str
+        The key for the batch table, from get_batch_key.
+    scans : list of tuple
+        (uid, dataset, metadata) for each scan, all with the same get_batch_schema.
+    chunk_nbytes : int, optional
+        Target bytes per table partition.
+
+    Returns
+    -------
+    int
+        The number of requests made.
+    """
+    frames = []
+    entries = {}
+    start = 0
+    for uid, ds, metadata in scans:
+        columns, _ = split_columns(ds)
+        frames.append(
+            pd.DataFrame(
+                {name: np.asarray(ds.variables[name].data) for name in columns}
+            )
+        )
+        entries[uid] = {
+            "metadata": metadata,
+            "attrs": dict(ds.attrs),
+            "column_attrs": {name: dict(ds.variables[name].attrs) for name in columns},
+            "rows": [start, start + len(frames[-1])],
+        }
+        start += len(frames[-1])
+    df = pd.concat(frames, ignore_index=True)
+    row_nbytes = max(1, int(df.memory_usage(index=False).sum()) // max(1, len(df)))
+    rows = max(1, chunk_nbytes // row_nbytes)
+    starts = range(0, max(1, len(df)), rows)
+    structure = dataclasses.replace(
+        TableStructure.from_pandas(df), npartitions=len(starts)
+    )
+    first_ds = scans[0][1]
+    table_client = with_retries(
+        container.new,
+        StructureFamily.table,
+        [DataSource(structure_family=StructureFamily.table, structure=structure)],
+        key=key,
+        metadata={
+            UIDS_KEY: list(entries),
+            COMPLETE_KEY: False,
+            STARTED_KEY: time.time(),
+            "dims": ["time"],
+            "coords": [name for name in df.columns if name in first_ds.coords],
+            "scans": entries,
+        },
+    )
+    for partition, start in enumerate(starts):
+        part = df.iloc[start : start + rows].reset_index(drop=True)
+        with_retries(table_client.write_partition, partition, part)
+    return 1 + len(starts)
+
+
+def read_scan_table(container, uid):
+    """
+    Read the 1-D columns written back for a scan, whether it was uploaded on its
+    own or as part of a batch.
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    if uid in container:
+        return container[uid][COLUMNS_KEY].read()
+    for node in container.search(Contains(UIDS_KEY, uid)).values():
+        start, stop = node.metadata["scans"][uid]["rows"]
+        return node.read().iloc[start:stop].reset_index(drop=True)
+    raise KeyError(uid)
+
+
+def mark_complete(container, key):
+    """
+    Record that every part of a scan or batch was uploaded, so later runs skip it.
+    """
+    with_retries(container[key].update_metadata, metadata={COMPLETE_KEY: True})
+
+
+def is_complete(container, key):
+    """
+    Whether a scan or batch is in the container and was fully uploaded.
+    """
+    return key in container and bool(container[key].metadata.get(COMPLETE_KEY))
+
+
+def is_written_back(container, uid):
+    """
+    Whether a scan was fully uploaded, on its own or as part of a batch.
+    """
+    if is_complete(container, uid):
+        return True
+    batches = container.search(Contains(UIDS_KEY, uid))
+    return any(node.metadata.get(COMPLETE_KEY) for node in batches.values())
+
+
+def get_writeback_state(container, since):
+    """
+    Find the uploads started since a time.
+
+    Parameters
+    ----------
+    container : Container
+        The processed tiled container.
+    since : float
+        Unix timestamp. Uploads of runs that started later cannot be older.
+
+    Returns
+    -------
+    complete : set of str
+        The uids of every scan that was fully uploaded.
+    partial : dict
+        Mapping of the key of each incomplete scan or batch to (the time its
+        upload started, the uids in it).
+    """
+    complete = set()
+    partial = {}
+    for key, node in container.search(Key(STARTED_KEY) >= since).items():
+        metadata = node.metadata
+        uids = list(metadata.get(UIDS_KEY, [key]))
+        if metadata.get(COMPLETE_KEY):
+            complete.update(uids)
+        else:
+            partial[key] = (metadata.get(STARTED_KEY, 0), uids)
+    return complete, partial
+
+
+def remove_partial_writeback(container, key, logger):
+    """
+    Delete a partially uploaded scan or batch so that a later run uploads it again.
+    """
+    if key not in container:
+        return
+    try:
+        container.delete_contents(key, recursive=True, external_only=False)
+    except Exception as e:
+        logger.info(f"Could not remove partial writeback for {key}: {e}")
+
+
+def is_backing_off(failure, now):
+    """
+    Whether a run that failed to upload should wait before it is tried again.
+
+    Parameters
+    ----------
+    failure : dict or None
+        The run's entry in the FAILURES_KEY record, with "count" and "time" of
+        the last failure.
+    now : float
+        The current Unix timestamp.
+    """
+    if not failure:
+        return False
+    delay = FAILURE_BACKOFF_SECONDS * 2 ** (failure["count"] - 1)
+    return now < failure["time"] + min(delay, FAILURE_BACKOFF_MAX_SECONDS)
+
+
+def find_recent_uids(catalog, since_hours):
+    """
+    Find the uids of successful runs with a data session that started recently.
+    """
+    since = time.time() - since_hours * 3600
+    uids = []
+    for uid, run in catalog.search(Key("start.time") >= since).items():
+        stop = run.metadata.get("stop") or {}
+        start = run.metadata.get("start", {})
+        if stop.get("exit_status") == "success" and start.get("data_session"):
+            uids.append(uid)
+    return uids
+
+
+@flow
+def tiled_writeback(
+    uids=None,
+    beamline_acronym="ucal",
+    processed_node="processed",
+    max_workers=8,
+    since_hours=24,
+    rixs_bin_widths=None,
+):
+    """
+    Upload normalized datasets for a batch of runs to a processed tiled container.
+
+    This runs as its own flow, separately from end_of_run_workflow, so uploads
+    never sit on the end-of-run critical path. Small scans that share a column
+    layout are uploaded together as the rows of one batch table; larger scans get
+    their own container. All uploads share one thread pool. A scan or batch is
+    marked complete only once all of it is uploaded. Complete scans are skipped.
+    Uploads left incomplete for STALE_SECONDS, e.g. by a worker that was killed,
+    are removed and done again, while newer ones are left to the run writing
+    them. Runs that fail are recorded in the processed container's metadata and
+    retried with exponential backoff instead of being read again every time.
+
+    Parameters
+    ----------
+    uids : list of str, optional
+        Unique identifiers for the runs to upload. Defaults to every successful
+        run with a data session that started in the last since_hours.
+    beamline_acronym : str, optional
+        Beamline identifier
+    processed_node : str, optional
+        Name of the processed container under the beamline node
+    max_workers : int, optional
+        Number of concurrent upload requests
+    since_hours : float, optional
+        How far back to look for runs, and for earlier uploads of them
+    rixs_bin_widths : list of (float, float), optional
+        (incident, emission) bin widths of the RIXS maps, one pair per map.
+        Defaults to multiples of the native spacing.
+
+    Returns
+    -------
+    list of str
+        The uids that failed to upload.
+    """
+    logger = get_run_logger()
+    catalog = initialize_tiled_client(beamline_acronym)
+    container = initialize_tiled_client(beamline_acronym, processed_node)
+    now = time.time()
+    since = now - since_hours * 3600
+    complete, partial = get_writeback_state(container, since)
+    if uids is None:
+        uids = find_recent_uids(catalog, since_hours)
+    else:
+        # Runs given explicitly may have been uploaded before since
+        complete.update(uid for uid in uids if is_written_back(container, uid))
+    in_progress = set()
+    for key, (started, partial_uids) in partial.items():
+        if now - started > STALE_SECONDS:
+            remove_partial_writeback(container, key, logger)
+        else:
+            in_progress.update(partial_uids)
+    failures = {
+        uid: dict(failure)
+        for uid, failure in container.metadata.get(FAILURES_KEY, {}).items()
+    }
+
+    pending = {}
+    batches = {}
+    failed = []
+    succeeded = []
+
+    def submit_batch(scans):
+        key = get_batch_key(scans)
+        future = executor.submit(upload_batch, container, key, scans)
+        pending[key] = ([uid for uid, _, _ in scans], [future])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for uid in uids:
+            if uid in complete:
+                continue
+            if uid in in_progress:
+                logger.info(f"{uid} is being written back by another run, skipping")
+                continue
+            if is_backing_off(failures.get(uid), now):
+                logger.info(f"{uid} failed recently, skipping")
+                continue
+            try:
+                exported = export_to_tiled(
+                    catalog[uid], rixs_bin_widths=rixs_bin_widths
+                )
+                if exported is False:
+                    continue
+                ds, metadata = exported
+                schema = get_batch_schema(ds)
+                if schema is None:
+                    futures = submit_dataset(container, uid, ds, metadata, executor)
+                    pending[uid] = ([uid], futures)
+                    continue
+                batches.setdefault(schema, []).append((uid, ds, metadata))
+                if len(batches[schema]) >= BATCH_MAX_SCANS:
+                    submit_batch(batches.pop(schema))
+            except Exception as e:
+                logger.info(f"Could not start writeback for {uid}: {e}")
+                failed.append(uid)
+                remove_partial_writeback(container, uid, logger)
+        for scans in batches.values():
+            submit_batch(scans)
+        for key, (key_uids, futures) in pending.items():
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            if not errors:
+                try:
+                    mark_complete(container, key)
+                except Exception as e:
+                    errors.append(e)
+            if errors:
+                logger.info(f"Writeback of {key} failed: {errors[0]}")
+                failed.extend(key_uids)
+                remove_partial_writeback(container, key, logger)
+            else:
+                nrequests = 1 + sum(f.result() for f in futures)
+                logger.info(
+                    f"Wrote back {key} ({len(key_uids)} scans) in {nrequests} requests"
+                )
+                succeeded.extend(key_uids)
+
+    update_failures(container, failures, failed, succeeded, since, now, logger)
+    return failed
+
+
+def update_failures(container, failures, failed, succeeded, since, now, logger):
+    """
+    Record the runs that failed to upload, forget those that were uploaded or are
+    too old to be tried again, and save the record if it changed.
+    """
+    updated = {
+        uid: failure
+        for uid, failure in failures.items()
+        if failure["time"] >= since and uid not in succeeded
+    }
+    for uid in failed:
+        count = failures.get(uid, {}).get("count", 0) + 1
+        updated[uid] = {"count": count, "time": now}
+    if updated == failures:
+        return
+    # The update is merged into the stored record, so forgotten runs are deleted
+    patch = {uid: DELETE_KEY for uid in failures if uid not in updated}
+    patch.update(updated)
+    try:
+        # Only the current record matters; don't keep a revision of each update
+        with_retries(
+            container.update_metadata,
+            metadata={FAILURES_KEY: patch},
+            drop_revision=True,
+        )
+    except Exception as e:
+        logger.info(f"Could not record writeback failures: {e}")
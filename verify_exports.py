@@ -0,0 +1,94 @@
+import argparse
+import glob
+import hashlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, exists, getsize, join
+
+from export_tools import MANIFEST_NAME, read_manifest
+
+# Bytes read at a time while hashing
+READ_NBYTES = 8 * 1024 * 1024
+
+
+def hash_file(filename, algorithm):
+    h = hashlib.new(algorithm)
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(READ_NBYTES)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def verify_entry(visit_path, entry):
+    """
+    Check one exported file against its manifest entry.
+
+    Returns
+    -------
+    str
+        "ok", "missing", "size mismatch", or "checksum mismatch".
+    """
+    filename = join(visit_path, entry["path"])
+    if not exists(filename):
+        return "missing"
+    if getsize(filename) != entry["size"]:
+        return "size mismatch"
+    if hash_file(filename, entry["algorithm"]) != entry["checksum"]:
+        return "checksum mismatch"
+    return "ok"
+
+
+def verify_proposal(proposal_path, max_workers=8):
+    """
+    Verify every exported file listed in the visit manifests of a proposal.
+
+    Files are hashed in parallel, each with a single streaming read.
+
+    Parameters
+    ----------
+    proposal_path : str
+        The proposal directory, containing <date>_export visit directories.
+    max_workers : int, optional
+        Number of files hashed at once.
+
+    Returns
+    -------
+    dict
+        Mapping of file path to its status, for every file that is not "ok".
+    """
+    # Visit manifests from export_format, and per-folder manifests from exporters
+    # called directly
+    manifests = sorted(
+        glob.glob(join(proposal_path, "*_export", MANIFEST_NAME))
+        + glob.glob(join(proposal_path, "*_export", "*", MANIFEST_NAME))
+    )
+    jobs = []
+    for manifest_path in manifests:
+        visit_path = dirname(manifest_path)
+        for entry in read_manifest(manifest_path).values():
+            jobs.append((visit_path, entry))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        statuses = executor.map(lambda job: verify_entry(*job), jobs)
+        problems = {}
+        for (visit_path, entry), status in zip(jobs, statuses):
+            if status != "ok":
+                problems[join(visit_path, entry["path"])] = status
+    print(f"Checked {len(jobs)} files in {len(manifests)} visits")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Verify exported files against their visit manifests"
+    )
+    parser.add_argument("proposal_path")
+    parser.add_argument("--max-workers", type=int, default=8)
+    args = parser.parse_args()
+    problems = verify_proposal(args.proposal_path, args.max_workers)
+    for filename, status in problems.items():
+        print(f"{status}: {filename}")
+    sys.exit(1 if problems else 0)